@@ -0,0 +1,225 @@
+
+#
+# Microbenchmarks for the CPU hot paths of modbus.py (no device I/O):
+#
+#  - ModbusSpec.parse() and ModbusSpec.expand_()
+#  - ModbusSpec.apply_format() for each code of FORMATTERS
+#  - expand_specifications() and get_all_aliases() on a large alias tree
+#
+# The inputs are fixed: the specifications and aliases of config_venus3.yaml,
+# with the 'info' section replicated SCALE times for the alias benchmarks,
+# and constant register values.
+#
+# For each benchmark, the number of operations per second (best of the
+# repeats) and the memory allocated by one operation (the peak reported by
+# tracemalloc) are reported. For example:
+#
+#    python3 bench_modbus.py
+#    python3 bench_modbus.py -k apply_format -t 2
+#    python3 bench_modbus.py --save before.json
+#    python3 bench_modbus.py --compare before.json --max-regression 10
+#
+# With --compare, the exit status is 1 when a benchmark is slower than in
+# the saved results by more than --max-regression percent.
+#
+
+import argparse
+import copy
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+import modbus
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config_venus3.yaml')
+
+#
+# Return the specifications of the 'info' section of a configuration
+# (the blocks and the comments of their values)
+#
+def config_specs(config):
+    specs = []
+    for block, value in config.get('info',{}).items():
+        specs.append(block)
+        if type(value) is dict:
+            specs.extend( key for key in value if re.match(r'^[hicd]\d', key) )
+    return specs
+
+#
+# Return a copy of the configuration with the 'info' section replicated
+# scale times.
+#
+# In the copy k, the addresses are shifted by k and the aliases get a '_k'
+# suffix. The copies are also appended to a group alias '@group_G' for
+# each group of 10 copies and the groups to '@everything' so the alias
+# tree is deeper than in the original configuration.
+#
+def scale_config(config, scale):
+    info = {}
+    alias = dict(config.get('alias',{}))
+    shift = lambda text, k: re.sub(r'\b([hicd])(\d+)',
+                                   lambda m: f"{m.group(1)}{(int(m.group(2))+k) % 0x10000}",
+                                   text)
+    for k in range(scale):
+        group = f'@group_{k//10}'
+        for block, value in config.get('info',{}).items():
+            if type(value) is dict:
+                value = copy.deepcopy(value)
+                if 'alias' in value:
+                    value['alias'] = f"{value['alias']}_{k}"
+                value['append'] = [ f"{name}_{k}" for name in value.get('append',[]) ] + [ group ]
+                value = { shift(key,k) if re.match(r'^[hicd]\d', key) else key: v
+                          for key, v in value.items() }
+            info[shift(block,k)] = value
+        alias.setdefault('@everything', [])
+        if group not in alias['@everything']:
+            alias['@everything'].append(group)
+    out = dict(config)
+    out['info'] = info
+    out['alias'] = alias
+    return out
+
+#
+# Constant register values for a spec of COUNT registers with the format
+# code CODE.
+#
+def sample_registers(code, count):
+    if code == 'M':
+        # A schedule: every day from 08:00 to 17:00, discharge 800W, enabled
+        return [ 0x7F, 800, 1700, 800, 1 ] * (count//5)
+    if code == 's':
+        text = b'VNSE3-0123456789ABCDEF'.ljust(2*count, b'\0')[:2*count]
+        return [ int.from_bytes(text[i:i+2],'big') for i in range(0, 2*count, 2) ]
+    return [ (0x9E37*(i+1)) & 0xFFFF for i in range(count) ]
+
+#
+# Return the list of benchmarks (NAME, FUNCTION)
+#
+def make_benchmarks(scale):
+    config = modbus.load_config(CONFIG)
+    specs  = config_specs(config)
+    benchmarks = []
+
+    # ModbusSpec.parse() over all the specifications of the configuration
+    def bench_parse():
+        for spec in specs:
+            modbus.ModbusSpec.parse(spec)
+    benchmarks.append( (f'parse x{len(specs)}', bench_parse) )
+
+    # ModbusSpec.expand_() over the same formats (with and without count)
+    formats = []
+    for spec in specs:
+        rg = modbus.ModbusSpec.parse(spec)
+        formats.append( (rg.fmt, rg.count) )
+        formats.append( (rg.fmt, None) )
+    def bench_expand():
+        for fmt, count in formats:
+            modbus.ModbusSpec.expand_(fmt, count)
+    benchmarks.append( (f'expand_ x{len(formats)}', bench_expand) )
+
+    # ModbusSpec.apply_format() for each formatter: a block of 10 values
+    for code, (packed, size, converter) in modbus.FORMATTERS.items():
+        count = 10*size
+        rg = modbus.ModbusSpec.parse(f'h40000_{count}.{code}')
+        registers = sample_registers(code, count)
+        benchmarks.append( (f'apply_format {code} x{len(rg.elem_names())}',
+                            lambda rg=rg, registers=registers: rg.apply_format(registers)) )
+
+    # get_all_aliases() and expand_specifications() on the scaled configuration
+    big = scale_config(config, scale)
+    aliases = modbus.get_all_aliases(big)
+    benchmarks.append( (f'get_all_aliases x{scale}', lambda: modbus.get_all_aliases(big)) )
+    benchmarks.append( (f'expand_specifications @everything x{scale}',
+                        lambda: modbus.expand_specifications(['@everything'], aliases)) )
+    benchmarks.append( (f'expand_specifications @all_0 x{scale}',
+                        lambda: modbus.expand_specifications(['@all_0'], aliases)) )
+    return benchmarks
+
+#
+# Run a benchmark for about duration seconds and return (OPS, ALLOC) where
+# OPS is the best number of operations per second over the repeats and
+# ALLOC is the peak memory allocated by one operation in bytes.
+#
+def run_benchmark(func, duration, repeats=5):
+    # Calibrate the number of operations per repeat
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= duration/repeats/4:
+            break
+        number = number*2
+    number = max(1, int(number * (duration/repeats) / max(elapsed, 1e-9)))
+
+    best = None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    alloc = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    return number/best, alloc
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the CPU hot paths of modbus.py')
+    parser.add_argument('-t', '--time', type=float, default=1.0,
+                        help='Duration of each benchmark in seconds (default 1.0)')
+    parser.add_argument('-s', '--scale', type=int, default=50,
+                        help='Number of copies of the info section for the alias benchmarks (default 50)')
+    parser.add_argument('-k', '--filter', metavar='PATTERN',
+                        help='Only run the benchmarks whose name matches that regular expression')
+    parser.add_argument('--save', metavar='FILE', help='Save the results in JSON')
+    parser.add_argument('--compare', metavar='FILE', help='Compare with results saved by --save')
+    parser.add_argument('--max-regression', metavar='PERCENT', type=float, default=20.0,
+                        help='With --compare, fail when a benchmark is that much slower (default 20)')
+    args = parser.parse_args()
+
+    benchmarks = make_benchmarks(args.scale)
+    if args.filter:
+        benchmarks = [ (name, func) for name, func in benchmarks if re.search(args.filter, name) ]
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    results = {}
+    failed = []
+    print(f"# {'benchmark':42} {'ops/s':>12} {'us/op':>10} {'bytes/op':>10}")
+    for name, func in benchmarks:
+        ops, alloc = run_benchmark(func, args.time)
+        results[name] = { 'ops': ops, 'alloc': alloc }
+        line = f"{name:44} {ops:12.1f} {1e6/ops:10.2f} {alloc:10d}"
+        if name in previous:
+            change = 100.0*(ops/previous[name]['ops'] - 1)
+            line = line + f" {change:+6.1f}%"
+            if change < -args.max_regression:
+                failed.append(name)
+        print(line, flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if failed:
+        print(f"# Regression above {args.max_regression:g}% in {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
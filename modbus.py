@@ -7,6 +7,23 @@ import ctypes
 import re
 import yamale
 import pprint
+import json
+import threading
+import contextlib
+import ast
+import shlex
+import mmap
+import os
+import array
+import queue
+import subprocess
+import importlib
+import urllib.request
+import math
+import http.server
+import socket
+import struct
+import copy
 
 from datetime import datetime
 
@@ -24,18 +41,43 @@ from pymodbus import (
 
 DEFAULT_HOSTNAME="venus.private"
 DEFAULT_PORT=502
+DEFAULT_CACHE_TTL=1.0       # seconds (see RegisterCache)
+DEFAULT_SUPPRESS_TTL=1.0    # seconds (see VenusSession.flush_writes)
+DEFAULT_WRITE_INTERVAL=0.0  # seconds (see VenusSession.flush_writes)
 
 YAML_INDENT=2
 
 YAMALE_SCHEMA = yamale.make_schema(content="""
 global: include('Global',required=False) 
-info:    map(null(), str(), map(str(),list(str()),null()), required=False)
+info:    map(null(), str(), map(str(),list(str()),num(),null()), required=False)
 alias:   map(str(), list(str()), key=str(), required=False)
+virtual: map(str(), include('Virtual'), key=str(), required=False)
+trigger: map(str(), include('Trigger'), key=str(), required=False)
 ---
 Global:
   loglevel: enum('DEBUG','INFO','WARNING','ERROR','CRITICAL', required=False)
   host: str(required=False)
   port: int(min=0,max=65535,required=False)
+  cache_ttl: num(min=0,required=False)
+  suppress_ttl: num(min=0,required=False)
+  write_interval: num(min=0,required=False)
+
+Virtual:
+  expr: str()
+  info: str(required=False)
+  format: str(required=False)
+
+Trigger:
+  value: str()
+  above: num(required=False)
+  below: num(required=False)
+  change: bool(required=False)
+  rate: num(min=0, required=False)
+  hysteresis: num(min=0, required=False)
+  debounce: num(min=0, required=False)
+  run: str(required=False)
+  webhook: str(required=False)
+  call: str(required=False)
 
 """)
 
@@ -61,12 +103,7 @@ alias:
 
 """)
 
-# Will be populated with comments for the data entries
-COMMENTS = {
-}
-
-ALIASES = {
-}
+log = logging.getLogger('pymodbus')
 
 #
 # Formaters for uint16 register values  
@@ -89,7 +126,7 @@ def r_to_x(r):
     return "0x{:04X}".format(r)
 
 def rr_to_B(hi,lo):
-    return "0b{:016b}{.016b}".format(hi,lo)
+    return "0b{:016b}{:016b}".format(hi,lo)
 
 def rr_to_U(hi,lo):
     return str((hi<<16) + lo)
@@ -191,6 +228,18 @@ class ModbusSpec:
 
     def name(self):
         return f"{self.start}_{self.count}.{self.fmt}" 
+
+    # The names of the values produced by this spec (see monitor)
+    def elem_names(self):
+        names = []
+        address = self.start
+        for elem in self.elems:
+            for k in range(elem.repeat):
+                if address + elem.size > self.start + self.count:
+                    break
+                names.append(f"{self.kind}{address}_{elem.size}.{elem.code}")
+                address = address + elem.size
+        return names
            
     # Parse a register range specification into a ModbusSpec object
     @staticmethod
@@ -265,10 +314,19 @@ class ModbusSpec:
             raise Exception(f"Data '{self.kind}' is not implemented")
         
         if ans.isError():
-            error_value = f"Modbus '{modbus_exception_name(ans.exception_code)}'"
-            return [ ( self.count, error_value , '?' ) ]
+            return self.error(ans)
         else:
-            return self.apply_format(ans.registers)
+            return self.decode(ans.registers)
+
+    # The result of read() for an error response  
+    def error(self, ans):
+        error_value = f"Modbus '{modbus_exception_name(ans.exception_code)}'"
+        return [ ( self.count, error_value , '?' ) ]
+
+    # The result of read() for the register values 
+    def decode(self, rvalues):
+        with TRACE.span('decode', 'decode', spec=self.name()):
+            return self.apply_format(rvalues)
 
 
     #
@@ -289,12 +347,10 @@ class ModbusSpec:
             if c.isdigit():
                 count=count*10+int(c)
                 if count>=65536:
-                    print(f"Unexpected large number in format '{fmt}'")
-                    sys.exit(1)
+                    raise ValueError(f"Unexpected large number in format '{fmt}'")
                 continue
             if not c in FORMATTERS:
-                print(f"Unsupported character '{c}' in data specification")
-                sys.exit(1)
+                raise ValueError(f"Unsupported character '{c}' in data specification")
 
             packed, size, converter = FORMATTERS[c]
 
@@ -362,14 +418,375 @@ class ModbusSpec:
 
         return results
 
-def modbus_connect(config):
+#
+# A virtual register is computed locally by an expression over the values
+# of other registers (physical or virtual). For example, in the YAML config:
+#
+#   virtual:
+#     v_stored_energy:
+#       expr: 'h32104_1.u * h32105_1.u / 100000'
+#       info: 'Stored energy (kWh)'
+#       format: '.2f'
+#
+# The expression is a Python expression restricted to numbers, arithmetic,
+# comparisons, conditionals and a few functions (see VIRTUAL_FUNCTIONS).
+# The register values are converted to numbers when possible.  
+#
+# The expression is compiled once and evaluated for each new set of values.
+#
+
+# Matches the references to physical registers in an expression (e.g. 'h30001_1.i')
+VIRTUAL_REF_PATTERN = re.compile(r'\b([hicd]\d+_\d+)\.([A-Za-z])\b')
 
-    if args.marstek_fix:
-        packet_filter = marstek_packet_correction
-    else:
-        packet_filter = None
+VIRTUAL_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+VIRTUAL_FUNCTIONS = {
+    'abs': abs,
+    'min': min,
+    'max': max,
+    'round': round,
+    'int': int,
+    'float': float,
+}
+
+VIRTUAL_NODES = (
+    ast.Expression, ast.Constant, ast.Name, ast.Load,
+    ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call,
+    ast.operator, ast.unaryop, ast.boolop, ast.cmpop,
+)
+
+class VirtualRegister:
+
+    def __init__(self, name, expr, fmt=None, info=None):
+        if not VIRTUAL_NAME_PATTERN.match(name) or re.match(r'^[hicd]\d', name):
+            raise ValueError(f"Illegal virtual register name '{name}'")
+        self.name = name
+        self.expr = expr
+        self.fmt  = fmt
+        self.info = info
+
+        # Replace 'h30001_1.i' by the identifier 'h30001_1_i'
+        self.refs = {}  # identifier -> referenced name
+        def _ref(m):
+            ident = f"{m.group(1)}_{m.group(2)}"
+            self.refs[ident] = f"{m.group(1)}.{m.group(2)}"
+            return ident
+        source = VIRTUAL_REF_PATTERN.sub(_ref, expr)
+
+        try:
+            tree = ast.parse(source, mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f"Malformed expression in virtual register '{name}': {e.msg}")
+        for node in ast.walk(tree):
+            if not isinstance(node, VIRTUAL_NODES):
+                raise ValueError(f"Unsupported {type(node).__name__} in virtual register '{name}'")
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in VIRTUAL_FUNCTIONS:
+                    raise ValueError(f"Unsupported function call in virtual register '{name}'")
+            elif isinstance(node, ast.Name) and node.id not in VIRTUAL_FUNCTIONS:
+                if node.id not in self.refs:
+                    # Must be another virtual register
+                    self.refs[node.id] = node.id
+        self.code = compile(tree, f"<virtual {name}>", 'eval')
+
+        # The names of all the referenced registers 
+        self.deps = list(self.refs.values())
+
+    def __repr__(self):
+        return f"VirtualRegister<{self.name}={self.expr}>"
+
+    #
+    # Evaluate using the values in a dict name->str (as displayed by monitor)
+    # and return the textual representation of the result.
+    #
+    def evaluate(self, values):
+        env = dict(VIRTUAL_FUNCTIONS)
+        for ident, ref in self.refs.items():
+            if ref not in values:
+                return '?'
+            env[ident] = virtual_number(values[ref])
+        try:
+            result = eval(self.code, {'__builtins__': {}}, env)
+        except Exception as e:
+            return f"ERROR '{e}'"
+        if not isinstance(result, (int, float)):
+            # e.g. '?' or an error from another virtual register
+            return str(result)
+        if self.fmt:
+            try:
+                return format(result, self.fmt)
+            except ValueError as e:
+                return f"ERROR '{e}'"
+        if isinstance(result, float):
+            return f"{result:g}"
+        return str(result)
+
+# Convert a displayed register value to a number when possible 
+def virtual_number(text):
+    try:
+        return int(text, 0)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+#
+# Return the virtual registers from config['virtual'] sorted so that
+# each register comes after the virtual registers it depends on. 
+#
+def get_all_virtuals(config):
+
+    virtuals = {}
+    config_virtual = config.get('virtual',{})
+    for name in sorted(config_virtual.keys()):
+        value = config_virtual[name]
+        virtuals[name] = VirtualRegister(name, value['expr'], value.get('format'), value.get('info'))
+
+    ordered = {}
+    def _rec_order(name, stack):
+        if name in ordered:
+            return
+        if name in stack:
+            raise ValueError(f"Circular dependency in virtual register '{name}'")
+        for dep in virtuals[name].deps:
+            if dep in virtuals:
+                _rec_order(dep, stack+[name])
+            elif not VIRTUAL_REF_PATTERN.match(dep):
+                raise ValueError(f"Unknown register '{dep}' in virtual register '{name}'")
+        ordered[name] = virtuals[name]
+
+    for name in virtuals:
+        _rec_order(name, [])
+    return ordered
+
+#
+# Return the names of the physical registers required to compute
+# a list of virtual registers. 
+#
+def virtual_dependencies(names, virtuals):
+    out = []
+    def _rec_deps(name):
+        for dep in virtuals[name].deps:
+            if dep in virtuals:
+                _rec_deps(dep)
+            elif dep not in out:
+                out.append(dep)
+    for name in names:
+        _rec_deps(name)
+    return out
+
+
+#
+# Triggers are evaluated on the decoded values within the monitor loop
+# (see monitor --triggers). For example, in the YAML config:
+#
+#   trigger:
+#     discharging:
+#       value: 'h30001_1.i'   # a register or a virtual register
+#       above: 100            # the condition (see below)
+#       hysteresis: 20        
+#       debounce: 5           # the condition must hold for 5 seconds
+#       run: 'logger "Venus is discharging $VENUS_VALUE W"'
+#
+# A trigger has exactly one condition:
+#   - above: VALUE  - when the value rises above VALUE 
+#   - below: VALUE  - when the value falls below VALUE 
+#   - change: true  - when the value changes
+#   - rate: VALUE   - when the absolute rate of change exceeds VALUE per second
+#
+# The trigger fires once when its condition becomes true and has hold for 
+# 'debounce' seconds. It is re-armed when the condition is false again. With 
+# 'hysteresis', the value must also come back by that margin (e.g. below 80 for
+# 'above: 100' and 'hysteresis: 20').  
+#
+# When fired, the hooks are executed by a background thread (see TriggerRunner):
+#   - run: SHELL-COMMAND  - the event is passed in the environment variables
+#                           VENUS_TRIGGER, VENUS_NAME, VENUS_VALUE and VENUS_PREVIOUS
+#   - webhook: URL        - the event is POSTed as JSON
+#   - call: MODULE:FUNC   - the python function is called with the event dict
+#
+TRIGGER_CONDITIONS = [ 'above', 'below', 'change', 'rate' ]
+
+class Trigger:
+
+    def __init__(self, name, config):
+        self.name  = name
+        self.value = config['value']
+
+        # Note: 'above: 0' is a condition but 'change: false' is not 
+        conditions = [ c for c in TRIGGER_CONDITIONS
+                       if c in config and config[c] is not None
+                       and not (c == 'change' and config[c] is False) ]
+        if len(conditions) != 1:
+            raise ValueError(f"Trigger '{name}' needs exactly one of {', '.join(TRIGGER_CONDITIONS)}")
+        self.condition = conditions[0]
+        self.threshold = config[self.condition]
+        self.hysteresis = config.get('hysteresis', 0)
+        self.debounce = config.get('debounce', 0)
+
+        self.run     = config.get('run')
+        self.webhook = config.get('webhook')
+        self.call    = None
+        if 'call' in config:
+            module, sep, func = config['call'].partition(':')
+            try:
+                self.call = getattr(importlib.import_module(module), func)
+            except (ImportError, AttributeError, ValueError) as e:
+                raise ValueError(f"Cannot import '{config['call']}' in trigger '{name}': {e}")
+        if not (self.run or self.webhook or self.call):
+            raise ValueError(f"Trigger '{name}' has no hook (run, webhook or call)")
+
+        self.active    = False  # the condition (with hysteresis)
+        self.since     = None   # when the condition became active
+        self.fired     = False  # fired since the condition became active
+        self.previous  = None   # previous value and time 
+        self.previous_time = None
+        self.reference = None   # value of reference for 'change'
+
+    def __repr__(self):
+        return f"Trigger<{self.name}:{self.value} {self.condition} {self.threshold}>"
+
+    def _check(self, value, now):
+        h = self.hysteresis
+        if self.condition == 'change':
+            if self.reference is None:
+                self.reference = value
+            return value != self.reference
+        if type(value) not in (int,float):
+            return False
+        if self.condition == 'above':
+            return value > (self.threshold - h if self.active else self.threshold)
+        if self.condition == 'below':
+            return value < (self.threshold + h if self.active else self.threshold)
+        # rate
+        if type(self.previous) not in (int,float) or now <= self.previous_time:
+            return self.active
+        rate = abs(value - self.previous) / (now - self.previous_time)
+        return rate > (self.threshold - h if self.active else self.threshold)
+
+    #
+    # Update with a new value at time 'now' (monotonic)
+    #
+    # Return the event dict if the trigger fires else None.
+    #
+    def update(self, value, now):
+        event = None
+        self.active = self._check(value, now)
+        if self.active:
+            if self.since is None:
+                self.since = now
+            if not self.fired and now - self.since >= self.debounce:
+                self.fired = True
+                event = { 'trigger': self.name, 'name': self.value, 'value': value,
+                          'previous': self.previous, 'time': time.time() }
+                if self.condition == 'change':
+                    # Re-arm for the next change
+                    self.reference = value
+                    self.active = False
+        if not self.active:
+            self.since = None
+            self.fired = False
+        self.previous = value
+        self.previous_time = now
+        return event
+
+#
+# Return the triggers from config['trigger'].  
+#
+def get_all_triggers(config, virtuals):
+    triggers = {}
+    config_trigger = config.get('trigger',{})
+    for name in sorted(config_trigger.keys()):
+        trigger = Trigger(name, config_trigger[name])
+        if trigger.value not in virtuals and not VIRTUAL_REF_PATTERN.match(trigger.value):
+            raise ValueError(f"Unknown register '{trigger.value}' in trigger '{name}'")
+        triggers[name] = trigger
+    return triggers
+
+#
+# Execute the trigger hooks in a background thread so they never delay the polling.
+#
+# Events are dropped (with a warning) when too many are pending and a 'run'
+# hook is killed after TRIGGER_RUN_TIMEOUT seconds.
+#
+TRIGGER_RUN_TIMEOUT = 60.0
 
-    config_globals = config['global'] 
+class TriggerRunner:
+
+    def __init__(self, maxsize=100):
+        self.queue  = queue.Queue(maxsize)
+        self.thread = None
+
+    def submit(self, trigger, event):
+        log.info(f"Trigger '{trigger.name}' fired: {event['name']} = {event['value']}")
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._worker, name='triggers', daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait( (trigger, event) )
+        except queue.Full:
+            log.warning(f"Too many pending triggers. Dropping '{trigger.name}'")
+
+    # Wait for the pending hooks (at most timeout seconds) and stop the thread
+    #
+    # The thread is a daemon so a hook that is still running after the
+    # timeout does not prevent the exit.
+    def stop(self, timeout=10.0):
+        if self.thread is not None:
+            deadline = time.monotonic() + timeout
+            try:
+                self.queue.put( None, timeout=timeout )
+                self.thread.join( max(deadline - time.monotonic(), 0) )
+            except queue.Full:
+                pass
+            if self.thread.is_alive():
+                log.warning("Trigger hooks still running. Not waiting for them")
+            self.thread = None
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            trigger, event = item
+            with TRACE.span(f'trigger {trigger.name}', 'trigger'):
+                try:
+                    self._execute(trigger, event)
+                except Exception as e:
+                    log.error(f"Trigger '{trigger.name}' failed: {e}")
+
+    def _execute(self, trigger, event):
+        if trigger.run:
+            env = dict(os.environ)
+            env['VENUS_TRIGGER']  = trigger.name
+            env['VENUS_NAME']     = str(event['name'])
+            env['VENUS_VALUE']    = str(event['value'])
+            env['VENUS_PREVIOUS'] = str(event['previous'])
+            subprocess.run(trigger.run, shell=True, env=env, timeout=TRIGGER_RUN_TIMEOUT)
+        if trigger.webhook:
+            request = urllib.request.Request(trigger.webhook,
+                                             data=json.dumps(event).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=5.0) as response:
+                response.read()
+        if trigger.call:
+            trigger.call(event)
+
+
+def modbus_connect(config, marstek_fix=True):
+
+    # All packets go through the filter so that STATS can count the bytes
+    # and the retries even when the Marstek correction is disabled.
+    def packet_filter(sending: bool, data: bytes) -> bytes:
+        ModbusStats.active.packet(sending, data)
+        TRACE.instant('send' if sending else 'receive', 'packet', bytes=len(data))
+        if marstek_fix:
+            data = marstek_packet_correction(sending, data)
+        return data
+
+    config_global = config['global'] 
                 
     client = ModbusTcpClient(config_global['host'],
                              port=config_global['port'],
@@ -383,10 +800,548 @@ def modbus_connect(config):
     
     
 
-def read_holding_registers(client, reg, count):
-    return client.read_holding_registers(reg, count=count)
+#
+# Statistics collected for all the requests sent to the device.
+#
+# They are reported when the option --stats is set. 
+#
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+# The last bucket collects everything above the last bound. 
+STATS_LATENCY_BUCKETS = ( 0.025, 0.050, 0.100, 0.150, 0.200, 0.300, 0.500, 1.0, 2.0 )
+
+class ModbusRangeStats:
+
+    def __init__(self):
+        self.requests   = 0
+        self.errors     = 0     # Error responses and failed requests
+        self.retries    = 0
+        self.sent       = 0     # bytes
+        self.received   = 0     # bytes
+        self.latency    = 0.0   # total in seconds
+        self.latency_max = 0.0
+        self.histogram  = [0] * (len(STATS_LATENCY_BUCKETS)+1)
+        self.exceptions = {}    # exception name -> count
+
+    def add(self, latency, sends, sent, received, error, exception):
+        self.requests = self.requests + 1
+        self.retries  = self.retries + max(sends-1, 0)
+        self.sent     = self.sent + sent
+        self.received = self.received + received
+        self.latency  = self.latency + latency
+        self.latency_max = max(self.latency_max, latency)
+        k=0
+        while k < len(STATS_LATENCY_BUCKETS) and latency > STATS_LATENCY_BUCKETS[k]:
+            k=k+1
+        self.histogram[k] = self.histogram[k] + 1
+        if error:
+            self.errors = self.errors + 1
+        if exception is not None:
+            self.exceptions[exception] = self.exceptions.get(exception,0) + 1
+
+    def latency_avg(self):
+        return self.latency/self.requests if self.requests else 0.0
+
+    def error_rate(self):
+        return 100.0*self.errors/self.requests if self.requests else 0.0
+
+
+class ModbusStats:
+
+    active = None  # The ModbusStats of the request in progress (see begin())
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.total   = ModbusRangeStats()
+        self.ranges  = {}        # 'read h30000_8' -> ModbusRangeStats
+        self.disconnects = 0
+        self.disconnect_time = 0.0  # seconds lost to disconnections
+        self.disconnected_at = None # time of the last failure (if not recovered)
+        # Packet counters for the request in progress (see packet())
+        self.sends    = 0
+        self.sent     = 0
+        self.received = 0
+
+    # Called by the packet filter for all sent and received packets.
+    def packet(self, sending, data):
+        if sending:
+            self.sends = self.sends + 1
+            self.sent = self.sent + len(data)
+        else:
+            self.received = self.received + len(data)
+
+    def begin(self):
+        ModbusStats.active = self
+        self.sends    = 0
+        self.sent     = 0
+        self.received = 0
+        return time.monotonic()
+
+    #
+    # Record the outcome of a request started at t0 (see begin()).
+    #
+    #  - key    : a str identifying the register range (e.g. 'read h30000_8')
+    #  - ans    : the pymodbus response or None if the request failed
+    #
+    def end(self, key, t0, ans):
+        now = time.monotonic()
+        latency = now - t0
+        exception = None
+        if ans is None:
+            error = True
+            exception = 'FAILED'
+            self.disconnects = self.disconnects + 1
+            self.disconnect_time = self.disconnect_time + latency
+            self.disconnected_at = now
+        else:
+            error = ans.isError()
+            if error and isinstance(ans, ModbusExceptionResponse):
+                exception = modbus_exception_name(ans.exception_code)
+            if self.disconnected_at is not None:
+                # Also count the time between the failure and that request
+                self.disconnect_time = self.disconnect_time + (t0 - self.disconnected_at)
+                self.disconnected_at = None
+
+        if key not in self.ranges:
+            self.ranges[key] = ModbusRangeStats()
+        for rs in (self.total, self.ranges[key]):
+            rs.add(latency, self.sends, self.sent, self.received, error, exception)
+
+    #
+    # Print the statistics as comments. 
+    #
+    # Set per_range to False to skip the per-range details (e.g. for scan).
+    #
+    def report(self, per_range=True):
+        t = self.total
+        elapsed = time.monotonic() - self.started
+        ms = lambda x: f"{1000*x:.1f}ms"
+        print(f"# Stats: {t.requests} requests in {elapsed:.1f}s, "
+              f"{t.errors} errors ({t.error_rate():.1f}%), {t.retries} retries, "
+              f"{t.sent} bytes sent, {t.received} bytes received")
+        if t.requests == 0:
+            return
+        print(f"# Stats: latency avg={ms(t.latency_avg())} max={ms(t.latency_max)}")
+        buckets = [ f"<={1000*b:g}ms:{n}" for b,n in zip(STATS_LATENCY_BUCKETS, t.histogram) ]
+        buckets.append(f">{1000*STATS_LATENCY_BUCKETS[-1]:g}ms:{t.histogram[-1]}")
+        print(f"# Stats: latency histogram {' '.join(buckets)}")
+        if t.exceptions:
+            excs = [ f"{name}={n}" for name,n in sorted(t.exceptions.items()) ]
+            print(f"# Stats: exceptions {' '.join(excs)}")
+        lost = self.disconnect_time
+        if self.disconnected_at is not None:
+            lost = lost + (time.monotonic() - self.disconnected_at)
+        print(f"# Stats: {self.disconnects} disconnects, {lost:.1f}s lost")
+        if per_range:
+            for key in sorted(self.ranges.keys()):
+                rs = self.ranges[key]
+                excs = ''.join( f" {name}={n}" for name,n in sorted(rs.exceptions.items()) )
+                print(f"# Stats: {key:18} requests={rs.requests} errors={rs.errors} "
+                      f"retries={rs.retries} bytes={rs.sent}/{rs.received} "
+                      f"avg={ms(rs.latency_avg())} max={ms(rs.latency_max)}{excs}")
+        sys.stdout.flush()
+
+STATS = ModbusStats()
+ModbusStats.active = STATS
+
+# The requests of the background scan (see BackgroundScan) are not in STATS
+SCAN_STATS = ModbusStats()
+
+
+#
+# Timeline of the requests, sleeps, decoding and printing (see --trace).
+#
+# The events are saved in the Chrome trace-event JSON format that can be
+# loaded in chrome://tracing or https://ui.perfetto.dev
+#
+class Tracer:
+
+    def __init__(self):
+        self.enabled = False
+        self.events  = []
+        self.origin  = time.perf_counter_ns()
+        self.pid     = 1
+
+    # Current time in microseconds since the creation of the tracer.
+    def now(self):
+        return (time.perf_counter_ns() - self.origin) / 1000
+
+    def event(self, name, cat, ph, ts, **fields):
+        event = { 'name': name, 'cat': cat, 'ph': ph, 'ts': ts,
+                  'pid': self.pid, 'tid': threading.get_native_id() }
+        event.update(fields)
+        self.events.append(event)
+
+    def instant(self, name, cat, **args):
+        if self.enabled:
+            self.event(name, cat, 'i', self.now(), s='t', args=args)
+
+    @contextlib.contextmanager
+    def _span(self, name, cat, args):
+        ts = self.now()
+        try:
+            yield args
+        finally:
+            self.event(name, cat, 'X', ts, dur=self.now()-ts, args=args)
+
+    #
+    # Context manager recording a complete event.
+    #
+    # The yielded dict contains the event arguments so it can be
+    # updated within the span.
+    #
+    def span(self, name, cat, **args):
+        if not self.enabled:
+            return contextlib.nullcontext(args)
+        return self._span(name, cat, args)
+
+    # A traced time.sleep() that also records how late the wakeup was. 
+    def sleep(self, seconds):
+        if not self.enabled:
+            time.sleep(seconds)
+            return
+        with self.span('sleep', 'sleep', requested_us=seconds*1e6) as args:
+            t0 = time.perf_counter()
+            time.sleep(seconds)
+            args['drift_us'] = (time.perf_counter() - t0 - seconds) * 1e6
+
+    def save(self, filename):
+        meta = { 'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                 'args': { 'name': ' '.join(sys.argv) } }
+        with open(filename, 'w') as f:
+            json.dump( { 'traceEvents': [meta] + self.events,
+                         'displayTimeUnit': 'ms' }, f)
+
+TRACE = Tracer()
+
+
+#
+# A shared memory-mapped image of the holding registers (see --image).
+#
+# The polling process updates the image after each read so that other local
+# processes can read the latest values without any Modbus traffic. 
+#
+# The file has a fixed layout in the native byte order:
+#
+#   offset   size     content
+#   0        8        magic b'VENUSIMG'
+#   8        4        uint32 layout version (1)
+#   12       4        uint32 number of registers (65536)
+#   16       8        uint64 generation counter (odd while an update is in progress)
+#   24       8        double time.time() of the last update 
+#   32       32       reserved
+#   64       2*N      uint16 register values 
+#   64+2*N   8*N      double time.time() of the last update of each register (0 if never)
+#   64+10*N  N        uint8 flags of each register (see IMAGE_VALID and IMAGE_ERROR)
+#
+# The generation counter works as a seqlock: a reader must retry when the
+# counter is odd or when it changed during the copy.  
+#
+IMAGE_MAGIC    = b'VENUSIMG'
+IMAGE_VERSION  = 1
+IMAGE_COUNT    = 0x10000
+IMAGE_HEADER   = struct.Struct('=8sIIQd32x')
+IMAGE_VALUES   = IMAGE_HEADER.size
+IMAGE_TIMES    = IMAGE_VALUES + 2*IMAGE_COUNT
+IMAGE_FLAGS    = IMAGE_TIMES + 8*IMAGE_COUNT
+IMAGE_SIZE     = IMAGE_FLAGS + IMAGE_COUNT
+
+IMAGE_VALID = 0x01  # The value was successfully read 
+IMAGE_ERROR = 0x02  # The last read failed with a Modbus exception
+
+class RegisterImage:
+
+    def __init__(self):
+        self.filename = None
+        self.mm = None
+
+    def is_open(self):
+        return self.mm is not None
+
+    def open(self, filename, writable=False):
+        if writable:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != IMAGE_SIZE:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, IMAGE_SIZE)
+                self.mm = mmap.mmap(fd, IMAGE_SIZE)
+            finally:
+                os.close(fd)
+            magic, version, count, gen, updated = IMAGE_HEADER.unpack_from(self.mm, 0)
+            if magic != IMAGE_MAGIC or version != IMAGE_VERSION or count != IMAGE_COUNT:
+                IMAGE_HEADER.pack_into(self.mm, 0, IMAGE_MAGIC, IMAGE_VERSION, IMAGE_COUNT, 0, 0.0)
+            elif gen % 2 == 1:
+                # A previous writer died during an update
+                IMAGE_HEADER.pack_into(self.mm, 0, IMAGE_MAGIC, IMAGE_VERSION, IMAGE_COUNT, gen+1, updated)
+        else:
+            with open(filename, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), IMAGE_SIZE, access=mmap.ACCESS_READ)
+            magic, version, count, gen, updated = IMAGE_HEADER.unpack_from(self.mm, 0)
+            if magic != IMAGE_MAGIC or version != IMAGE_VERSION or count != IMAGE_COUNT:
+                raise ValueError(f"'{filename}' is not a register image")
+        self.filename = filename
+        # Zero-copy views on the mapped arrays
+        view = memoryview(self.mm)
+        self.values = view[IMAGE_VALUES:IMAGE_TIMES].cast('H')
+        self.times  = view[IMAGE_TIMES:IMAGE_FLAGS].cast('d')
+        self.flags  = view[IMAGE_FLAGS:IMAGE_SIZE]
+
+    def generation(self):
+        return struct.unpack_from('=Q', self.mm, 16)[0]
+
+    def _set_generation(self, gen, updated=None):
+        struct.pack_into('=Q', self.mm, 16, gen)
+        if updated is not None:
+            struct.pack_into('=d', self.mm, 24, updated)
+
+    # Store registers values read at address start. 
+    def update(self, start, registers, timestamp):
+        if self.mm is None:
+            return
+        count = min(len(registers), IMAGE_COUNT-start)
+        gen = self.generation()
+        self._set_generation(gen+1)
+        self.values[start:start+count] = array.array('H', registers[:count])
+        self.times[start:start+count] = array.array('d', [timestamp]) * count
+        self.flags[start:start+count] = bytes([IMAGE_VALID]) * count
+        self._set_generation(gen+2, timestamp)
+
+    #
+    # Record a Modbus exception for the register at address.
+    #
+    # Failed reads of multiple registers shall not be recorded because
+    # they do not tell which registers are illegal.
+    #
+    def invalidate(self, address, timestamp):
+        if self.mm is None:
+            return
+        gen = self.generation()
+        self._set_generation(gen+1)
+        self.times[address] = timestamp
+        self.flags[address] = IMAGE_ERROR
+        self._set_generation(gen+2, timestamp)
+
+    #
+    # Return a consistent copy of some register ranges.
+    #
+    #  - ranges : a list of (START, COUNT)
+    #
+    # The result is a list of (VALUES, TIMES, FLAGS) lists (one per range).
+    #
+    def snapshot(self, ranges):
+        while True:
+            gen = self.generation()
+            if gen % 2 == 1:
+                time.sleep(0.0001)
+                continue
+            out = [ ( self.values[a:a+n].tolist(), self.times[a:a+n].tolist(), self.flags[a:a+n].tolist() )
+                    for a, n in ranges ]
+            if self.generation() == gen:
+                return out
+
+IMAGE = RegisterImage()
+
+
+#
+# The request is recorded in stats (default STATS) under the key (default
+# 'read hSTART_COUNT').
+#
+def read_holding_registers(client, reg, count, stats=None, key=None):
+    stats = stats or STATS
+    key = key or f"read h{reg}_{count}"
+    t0 = stats.begin()
+    with TRACE.span(key, 'modbus'):
+        try:
+            ans = client.read_holding_registers(reg, count=count)
+        except ModbusException:
+            stats.end(key, t0, None)
+            raise
+    stats.end(key, t0, ans)
+    if not ans.isError():
+        IMAGE.update(reg, ans.registers, time.time())
+    elif count == 1:
+        IMAGE.invalidate(reg, time.time())
+    return ans
+
+def write_registers(client, reg, values):
+    key = f"write h{reg}_{len(values)}"
+    t0 = STATS.begin()
+    with TRACE.span(key, 'modbus'):
+        try:
+            ans = client.write_registers(address=reg, values=values)
+        except ModbusException:
+            STATS.end(key, t0, None)
+            raise
+    STATS.end(key, t0, ans)
+    return ans
     
 
+#
+# The read planner: merge the register ranges that are overlapping or
+# adjacent into a minimal number of read requests.
+#
+# This is a lot faster on the Venus because of the delay between requests.
+# Ranges separated by a gap are never merged because the gap may contain
+# illegal addresses.
+#
+
+MAX_READ_COUNT = 125  # Maximum number of registers in a read request
+
+class ReadRequest:
+
+    def __init__(self, kind, start, count):
+        self.kind   = kind
+        self.start  = start
+        self.count  = count
+        self.ranges = []  # the ModbusSpec covered by that request 
+
+    def __repr__(self):
+        return f"ReadRequest<{self.kind}{self.start}_{self.count}>"
+
+def plan_requests(ranges, limit=MAX_READ_COUNT):
+    requests = []
+    last = None
+    for rg in sorted(ranges, key=lambda rg: (rg.kind, rg.start, -rg.count)):
+        if ( last is not None and last.kind == rg.kind 
+             and rg.start <= last.start + last.count 
+             and max(last.count, rg.start + rg.count - last.start) <= limit ):
+            last.count = max(last.count, rg.start + rg.count - last.start)
+        else:
+            last = ReadRequest(rg.kind, rg.start, rg.count)
+            requests.append(last)
+        last.ranges.append(rg)
+    return requests
+
+#
+# Block-aligned speculative prefetch.
+#
+# A request costs the same whatever its size so the requests can be widened
+# for free to the known blocks of registers (a list of (START, COUNT), see
+# get_known_blocks) that they overlap, and to the blocks that are 
+# contiguous to them, as long as the request stays within the limit. The
+# extra registers end up in the cache (see RegisterCache).
+#
+# As for plan_requests, the gaps between blocks are never read.  
+#
+def prefetch_requests(requests, blocks, limit=MAX_READ_COUNT):
+    out = []
+    for req in requests:
+        start = req.start
+        end = req.start + req.count
+        if req.kind == 'h':
+            changed = True
+            while changed:
+                changed = False
+                for bstart, bcount in blocks:
+                    bend = bstart + bcount
+                    if ( bstart <= end and bend >= start and (bstart < start or bend > end)
+                         and max(end,bend) - min(start,bstart) <= limit ):
+                        start = min(start, bstart)
+                        end = max(end, bend)
+                        changed = True
+        last = out[-1] if out else None
+        if ( last is not None and last.kind == req.kind 
+             and start <= last.start + last.count and end >= last.start
+             and max(end, last.start + last.count) - min(start, last.start) <= limit ):
+            end = max(end, last.start + last.count)
+            last.start = min(start, last.start)
+            last.count = end - last.start
+        else:
+            last = ReadRequest(req.kind, start, end-start)
+            out.append(last)
+        last.ranges.extend(req.ranges)
+    return out
+
+#
+# Perform the read requests and return a dict ModbusSpec -> (ELEMS, TIMESTAMP, MONOTONIC)
+# where ELEMS is the result of ModbusSpec.read()
+#
+# When a merged request fails, its ranges are read individually so that
+# each of them gets its own result.
+#
+# The values successfully read are stored in the cache (see RegisterCache) when set. 
+#
+def execute_requests(client, requests, cache=None):
+    results = {}
+    for req in requests:
+        if req.kind != 'h':
+            for rg in req.ranges:
+                results[rg] = ( rg.read(client), time.time(), time.monotonic() ) 
+            continue
+        ans = read_holding_registers(client, req.start, req.count)
+        timestamp = time.time()
+        monotonic = time.monotonic()
+        if not ans.isError() and cache is not None:
+            cache.update(req.start, ans.registers, monotonic)
+        for rg in req.ranges:
+            if not ans.isError():
+                offset = rg.start - req.start
+                elems = rg.decode(ans.registers[offset:offset+rg.count])
+                results[rg] = ( elems, timestamp, monotonic )
+            elif len(req.ranges) == 1 and (req.start, req.count) == (rg.start, rg.count):
+                results[rg] = ( rg.error(ans), timestamp, monotonic )
+            else:
+                ans1 = read_holding_registers(client, rg.start, rg.count)
+                monotonic1 = time.monotonic()
+                if ans1.isError():
+                    elems = rg.error(ans1)
+                else:
+                    elems = rg.decode(ans1.registers)
+                    if cache is not None:
+                        cache.update(rg.start, ans1.registers, monotonic1)
+                results[rg] = ( elems, time.time(), monotonic1 )
+    return results
+
+
+#
+# A cache of the last values read or written by a session.
+#
+# A cached value is fresh for TTL seconds. The TTL of a register is the 
+# 'poll' key of its block in the 'info' section (see probe-rate) or the
+# global 'cache_ttl'.
+#
+class RegisterCache:
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL):
+        self.ttl    = ttl
+        self.ttls   = {}    # address -> TTL when different from the default
+        self.values = {}    # address -> (value, monotonic time)
+
+    def set_ttl(self, start, count, ttl):
+        for address in range(start, start+count):
+            self.ttls[address] = ttl
+
+    def update(self, start, registers, now=None):
+        if now is None:
+            now = time.monotonic()
+        for i, value in enumerate(registers):
+            self.values[start+i] = (value, now)
+
+    def invalidate(self, start, count):
+        for address in range(start, start+count):
+            self.values.pop(address, None)
+
+    #
+    # Return the list of cached values if they are all fresh else None.
+    #
+    # With max_age, the values must also be at most max_age seconds old. 
+    #
+    def get(self, start, count, now=None, max_age=None):
+        if now is None:
+            now = time.monotonic()
+        out = []
+        for address in range(start, start+count):
+            entry = self.values.get(address)
+            ttl = self.ttls.get(address, self.ttl)
+            if max_age is not None:
+                ttl = min(ttl, max_age)
+            if entry is None or now - entry[1] > ttl:
+                return None
+            out.append(entry[0])
+        return out
+
+
 def modbus_exception_name(code):
     try:
         return ModbusExcCodes(code).name
@@ -461,56 +1416,246 @@ def registers_to_string(values):
     return repr(data.rstrip(b'\0'))[1:]
 
 
+#
+# Deadline-based scheduling of the monitor iterations (see monitor --period).
+#
+# The ticks occur at START + K*PERIOD so the cadence does not drift when
+# the time spent reading varies. When an iteration overruns the next tick,
+# the policy decides what happens:
+#   - 'skip'     : the missed ticks are dropped and the next iteration 
+#                  waits for the next tick in the future.
+#   - 'catch-up' : the missed iterations are performed immediately 
+#                  (without sleeping) until the cadence is recovered.
+#
+CADENCE_POLICIES = [ 'skip', 'catch-up' ]
+
+class Cadence:
+
+    def __init__(self, period, policy='skip'):
+        if period <= 0:
+            raise ValueError(f"Illegal period {period}")
+        if policy not in CADENCE_POLICIES:
+            raise ValueError(f"Unknown overrun policy '{policy}'")
+        self.period = period
+        self.policy = policy
+        self.start  = time.monotonic()
+        self.tick   = 0  # index of the last tick 
+        self.missed = 0  # total number of ticks that were not on time
+
+    #
+    # Wait for the next tick and return the number of ticks that were
+    # missed (skip) or that are performed late (catch-up).
+    #
+    def wait(self):
+        self.tick = self.tick + 1
+        deadline = self.start + self.tick*self.period
+        now = time.monotonic()
+        if now < deadline:
+            TRACE.sleep(deadline-now)
+            return 0
+        if self.policy == 'skip':
+            missed = int((now-deadline)//self.period) + 1
+            self.tick = self.tick + missed
+            TRACE.sleep(self.start + self.tick*self.period - now)
+        else:
+            missed = 1
+        self.missed = self.missed + missed
+        return missed
+
+
+#
+# Poll a list of specifications according to the 'poll' keys of the blocks
+# of the 'info' section (see probe-rate). The specifications that are not
+# in a block with a 'poll' key, including the virtual registers, are polled
+# every default period.
+#
+# Each group of specifications with the same period follows its own fixed
+# cadence (the missed ticks are skipped). The groups that are due at the 
+# same time are read together (see VenusSession.execute_many). 
+#
+class PollGroup:
+
+    def __init__(self, period, plan, deadline):
+        self.period   = period
+        self.plan     = plan
+        self.deadline = deadline  # monotonic time of the next poll
+        self.last     = None      # monotonic time of the last completed poll
+
+POLL_RETRY_MIN = 1.0   # seconds (see PollScheduler.poll_forever)
+POLL_RETRY_MAX = 60.0
+
+class PollScheduler:
+
+    def __init__(self, session, specs, period=1.0):
+        if period <= 0:
+            raise ValueError(f"Illegal period {period}")
+        self.session = session
+        polls = get_block_settings(session.config, 'poll')
+        speclists = {}  # period -> list of specs
+        for spec in expand_specifications(list(specs), session.aliases):
+            speclists.setdefault(self.spec_period(spec, polls, period), []).append(spec)
+        now = time.monotonic()
+        self.groups = [ PollGroup(p, session.plan(speclist), now)
+                        for p, speclist in sorted(speclists.items()) ]
+        self.cycles = 0     # number of poll() 
+        self.missed = 0     # total number of ticks missed by all groups
+        self.last   = None  # monotonic time of the last poll()
+
+    # The smallest 'poll' of the blocks containing spec else the default period
+    def spec_period(self, spec, polls, period):
+        if spec in self.session.virtuals:
+            return period
+        rg = ModbusSpec.parse(spec)
+        found = [ poll for start, count, poll in polls
+                  if start <= rg.start and rg.start+rg.count <= start+count and poll > 0 ]
+        return min(found) if found else period
+
+    # Seconds until the next poll is due (negative when late)
+    def idle(self):
+        return min( g.deadline for g in self.groups ) - time.monotonic()
+
+    #
+    # Wait until at least one group is due, read all the due groups and
+    # return their values (a list of ModbusValue).
+    #
+    def poll(self):
+        self.session.use_idle_time(time.monotonic() + self.idle())
+        delay = self.idle()
+        if delay > 0:
+            TRACE.sleep(delay)
+        now = time.monotonic()
+        due = [ g for g in self.groups if g.deadline <= now ]
+        results = self.session.execute_many([ g.plan for g in due ], cached=False)
+        now = time.monotonic()
+        for g in due:
+            g.last = now
+            g.deadline = g.deadline + g.period
+            if g.deadline < now:
+                missed = int((now-g.deadline)//g.period) + 1
+                g.deadline = g.deadline + missed*g.period
+                self.missed = self.missed + missed
+        self.cycles = self.cycles + 1
+        self.last = now
+        return [ v for out in results for v in out ]
+
+    #
+    # Call handle(values) after each poll(), forever.
+    #
+    # A Modbus error (e.g. a timeout or a reboot of the device) is logged
+    # and the connection is reopened after a delay that doubles up to 
+    # POLL_RETRY_MAX seconds. The values handled so far stay valid (e.g. 
+    # for serve-metrics while venus_poll_age_seconds grows).
+    #
+    def poll_forever(self, handle):
+        session = self.session
+        retry = POLL_RETRY_MIN
+        while True:
+            try:
+                values = self.poll()
+            except ModbusException as e:
+                log.warning(f"Polling failed: {e}. Reconnecting in {retry:g}s")
+                if session.client is not None:
+                    session.client.close()
+                    session.client = None
+                TRACE.sleep(retry)
+                retry = min(2*retry, POLL_RETRY_MAX)
+                continue
+            retry = POLL_RETRY_MIN
+            handle(values)
+
+    
+#
+# Print a list of ModbusValue (see monitor).
+#
+# previous_values is a dict name->value used to only display the changes 
+# (unless show_all is set). It is updated with the new values.  
+#
+def print_values(values,
+                 previous_values,
+                 first=True,
+                 show_spec=False,
+                 show_all=False,
+                 show_previous=False,
+                 show_time=False,
+                 show_monotonic=False,
+                 origin=0 ):
+    spec = None
+    for v in values:
+        if first and show_spec and v.spec is not None and v.spec != spec:
+            print(f"# Read {v.spec} ")
+        spec = v.spec
+
+        ts = ''
+        if show_monotonic:
+            ts = "[{:10.6f}] ".format(v.monotonic-origin)
+        if show_time:
+            ts = ts + datetime.fromtimestamp(v.timestamp).strftime("[%H:%M:%S.%f")[:-3] + "] "
+
+        previous = previous_values.get(v.name,None)
+        diff = previous!=v.value
+        show = show_all or diff
+
+        if show:
+            comment = f' # {v.comment}' if v.comment else ''
+            if show_previous and diff and not first:
+                print("{}{:12} = from {} to {:8}{}".format(ts,v.name,previous,v.value,comment) , flush=True)
+            else:
+                print("{}{:12} = {:10}{}".format(ts,v.name,v.value,comment) , flush=True)
+
+        previous_values[v.name] = v.value
+
+
 #
 # Used by action_monitor and action_read to read and display according to a list of specifications.
 #
+# When period is set, the iterations follow a fixed cadence (see Cadence)
+# else the loop sleeps for delay seconds after each iteration.
 #
-def monitor(client,
+def monitor(session,
             speclist,
             count=1,
             delay=0,
+            period=None,
+            overrun='skip',
             show_iteration=False,
             show_spec=False,
             show_all=False,
             show_previous=False,
-            show_time=False ):
+            show_time=False,
+            show_monotonic=False,
+            stats_interval=0,
+            triggers=False ):
 
-    speclist = expand_specifications( speclist, ALIASES)
-    ranges = list(map(ModbusSpec.parse, speclist))
     previous_values={} 
-    i=0
-    while True:
-        if show_iteration:
-            print(f"# Iteration {i+1}")
-        for rg in ranges:
-            if i==0 and show_spec: 
-                print(f"# Read {rg.name()} ")
-            kind    = rg.kind
-            address = rg.start
-            ts = datetime.now().strftime("[%H:%M:%S] ") if show_time else '' 
-            for elem in rg.read(client):
-                name = f"{kind}{address}_{elem[0]}.{elem[2]}"
-                value = elem[1]
-
-                previous = previous_values.get(name,None)
-                diff = previous!=value
-                show = show_all or diff
-
-                if show:
-                    comment = f' # {COMMENTS[name]}' if (name in COMMENTS) else ''
-                    if show_previous and diff and i>0:
-                        print("{}{:12} = from {} to {:8}{}".format(ts,name,previous,value,comment) , flush=True)
-                    else:
-                        print("{}{:12} = {:10}{}".format(ts,name,value,comment) , flush=True)
-
-                previous_values[name] = value
-                
-                address = address + elem[0]
-        
-        i=i+1 
-        if i==count:
-            break
-        time.sleep(delay)
+    next_stats = time.monotonic() + stats_interval
+    origin = time.monotonic()
+
+    iterations = session.monitor(speclist, count=count, delay=delay, period=period, overrun=overrun, triggers=triggers)
+    for i, values in enumerate(iterations):
+        if session.missed > 0:
+            if overrun == 'skip':
+                print(f"# Overrun after iteration {i}: skipped {session.missed} ticks ({session.cadence.missed} in total)", flush=True)
+            else:
+                print(f"# Overrun after iteration {i}: late tick ({session.cadence.missed} in total)", flush=True)
+        if session.cadence:
+            origin = session.cadence.start
+
+        with TRACE.span('print', 'print', iteration=i+1):
+            if show_iteration:
+                print(f"# Iteration {i+1}")
+            print_values( values,
+                          previous_values,
+                          first=(i==0),
+                          show_spec=show_spec,
+                          show_all=show_all,
+                          show_previous=show_previous,
+                          show_time=show_time,
+                          show_monotonic=show_monotonic,
+                          origin=origin )
+
+        if stats_interval > 0 and time.monotonic() >= next_stats:
+            STATS.report()
+            next_stats = next_stats + stats_interval
 
 
 def add_command_read(subparsers):
@@ -518,18 +1663,21 @@ def add_command_read(subparsers):
     sp.add_argument('read_speclist', metavar='SPEC', nargs='+', help='read specification')
     sp.add_argument('-S', '--show-spec', dest='read_show_spec', action='store_true')
     
-def action_read(args, config):
+def action_read(args, session):
     count  = 1
     show_spec = args.read_show_spec
     
-    client = modbus_connect(config)
+    session.connect()
 
-    monitor( client,
+    monitor( session,
              args.read_speclist,
              count=1,
              show_spec=show_spec,
     )
-    client.close()
+    session.close()
+
+    if args.stats:
+        STATS.report()
     
 
 
@@ -537,72 +1685,48 @@ def add_command_write(subparsers):
     sp = subparsers.add_parser('write', help='write registers')    
     sp.add_argument('write_list', metavar='SPEC=VALUE', nargs='+', help='')
     sp.add_argument('-S', '--show-spec', dest='write_show_spec', action='store_true')
+    sp.add_argument('-f', '--force', dest='write_force', action='store_true',
+                    help='Write even when the target is known to hold the value')
 
-def action_write(args, config):
+def action_write(args, session):
     count  = 1
     show_spec = args.write_show_spec
 
-    client = modbus_connect(config)
-    
-    for assign in args.write_list:
-        try:
-            [dest,value_str] = assign.split('=',1)
-            value = int(value_str,0)
-            dest=dest.strip()
-        except ValueError:
-            print(f"Error: Malformed assignment '{assign}'")
-            sys.exit(1)
+    session.connect()
+    write_assignments(session, args.write_list, args.write_force)
+    session.close()
 
-        # Expand 'dest' and make sure that it describes a single
-        # target of size 1 or 2.  
-        speclist = expand_specifications( [dest] , ALIASES)
-        if len(speclist)==0:
-            print(f"Error: Empty assignment target '{dest}'")
-            sys.exit(1)
-        elif len(speclist)>1:
-            print(f"Error: Too many assignment targets in '{dest}'")
-            sys.exit(1)
-        target = ModbusSpec.parse(speclist[0])
+# Return the (DEST, VALUE) of a 'SPEC=VALUE' assignment 
+def parse_assignment(assign):
+    try:
+        [dest,value_str] = assign.split('=',1)
+        value = int(value_str,0)
+    except ValueError:
+        raise ValueError(f"Malformed assignment '{assign}'")
+    return dest.strip(), value
 
-        if target.count not in [1,2]:
-            print(f"Error: Illegal assignment target size in '{dest}'. Got {target.count} but need 1 or 2")
+# Perform a list of 'SPEC=VALUE' assignments (see action_write)
+#
+# The writes are coalesced (the last assignment to a target wins) and 
+# suppressed when the target is known to already hold the value unless
+# force is set (see VenusSession.flush_writes).
+#
+def write_assignments(session, write_list, force=False):
+    for assign in write_list:
+        try:
+            dest, value = parse_assignment(assign)
+            session.queue_write(dest, value)
+        except ValueError as e:
+            print(f"Error: {e}")
             sys.exit(1)
 
-        # TODO: implement arbitrary assignment size? 
-        if target.count == 1:
-            print("WRITE",target.start, [value] )
-            ans = client.write_registers(address=target.start, values=[value])
-            print(ans)
-        elif target.count == 2:
-            hi = (value>>16) & 0xFFFF
-            lo = value & 0xFFFF
-            #client.write_registers(address=target.start,values=[hi,lo])
+    for dest, values, ans in session.flush_writes(force=force, wait=True):
+        if ans is None:
+            print("SKIP", dest, values, "(unchanged)")
         else:
-            print(f"Error: Illegal assignment target size ({target.count}) in '{dest}'")
-            sys.exit(1)
-
-
-        
-        #ranges = ModbusSpec.parse(speclist[0])
-        #if len(ranges)!=1 :
-        #    print(f"Error: Invalid assignment target '{dest}'")
-        #    sys.exit(1)        
-        #print( ranges[0].elems )
-        #if len( ranges[0].elems) != 1 :
-        #    print(f"Error: Multiple assignment targets specified by '{dest}'")
-        #    sys.exit(1)
-        #if len( ranges[0].elems) != 1 :
-        #    print(f"Error: Multiple assignment targets specified by '{dest}'")
-        #    sys.exit(1)
-        #
-        #print(ranges)
-        
-    #for rg in ranges:
-    #    print(rg)
-    
+            print("WRITE", dest, values )
+            print(ans)
 
-    client.close()
-    
 
     
 def add_command_monitor(subparsers):
@@ -618,6 +1742,17 @@ def add_command_monitor(subparsers):
                     type=float,
                     default=1.0 ,
                     help='Wait for that many seconds after each iteration (default 1.0)')
+    sp.add_argument('-p', '--period',
+                    dest='monitor_period',
+                    metavar='SECONDS',
+                    type=float,
+                    default=None ,
+                    help='Start an iteration every SECONDS at a fixed cadence (replace --delay)')
+    sp.add_argument('--overrun',
+                    dest='monitor_overrun',
+                    choices=CADENCE_POLICIES,
+                    default='skip' ,
+                    help='What to do with the ticks missed by a too long iteration when using --period (default skip)')
     sp.add_argument('-c', '--count',
                     dest='monitor_count',
                     action='store',
@@ -644,53 +1779,473 @@ def add_command_monitor(subparsers):
     sp.add_argument('-T', '--show-time',
                     dest='monitor_show_time',
                     action='store_true',
-                    help='Show a timestamp')
+                    help='Show a timestamp (with milliseconds)')
+    sp.add_argument('-M', '--show-monotonic',
+                    dest='monitor_show_monotonic',
+                    action='store_true',
+                    help='Show a monotonic timestamp in seconds since the start of the monitor')
+    sp.add_argument('-t', '--triggers',
+                    dest='monitor_triggers',
+                    action='store_true',
+                    help='Evaluate the triggers declared in the configuration')
+    sp.add_argument('--stats-interval',
+                    dest='monitor_stats_interval',
+                    metavar='SECONDS',
+                    type=float,
+                    default=0 ,
+                    help='Report the request statistics periodically (default 0 for never)')
 
     
-def action_monitor(args, config):
+def action_monitor(args, session):
+
+    session.connect()
+    try:
+        run_monitor(args, session)
+    finally:
+        # Also report after CTRL-C
+        if args.stats:
+            STATS.report()
+    session.close()
+
+# Run monitor() according to the monitor command arguments (see action_monitor)
+def run_monitor(args, session):
 
     count  = args.monitor_count  # Number of iterations (0 for infinite)
     delay  = args.monitor_delay  # Sleep delay after each iteration
+    period = args.monitor_period # Fixed cadence (replace delay)
+    overrun = args.monitor_overrun
+
+    if period is not None and period <= 0:
+        print(f"Illegal period {period}")
+        sys.exit(1)
 
     show_iteration = args.monitor_show_iteration
     show_spec      = args.monitor_show_spec
     show_all       = args.monitor_show_all
     show_previous  = args.monitor_show_previous
     show_time      = args.monitor_show_time
+    show_monotonic = args.monitor_show_monotonic
+    stats_interval = args.monitor_stats_interval
     
-    client = modbus_connect(config)
-
-    monitor( client,
+    monitor( session,
              args.monitor_speclist,
              count=count,
              delay=delay,
+             period=period,
+             overrun=overrun,
              show_iteration=show_iteration,
              show_spec=show_spec,
              show_all=show_all,
              show_previous=show_previous,
-             show_time=show_time
+             show_time=show_time,
+             show_monotonic=show_monotonic,
+             stats_interval=stats_interval,
+             triggers=args.monitor_triggers
     )
-    client.close()
-
-def add_command_scan(subparsers):
-    
-    sp = subparsers.add_parser('scan', help='Scan for readable registers')
-    sp.add_argument('scan_start', metavar='START', type=int, help='start address')
-    sp.add_argument('scan_end'  , metavar='END',   type=int, help='end address')
-    sp.add_argument('scan_step' , metavar='STEP',  type=int, nargs='?', default=10, help='step between addresses (default 10)')
-    sp.add_argument('-y','--yaml', dest='scan_yaml' , action='store_true', help="produce YAML configuration file") 
-    sp.add_argument('-Y','--yaml-all', dest='scan_yaml_all' , action='store_true', help="produce more YAML") 
-    sp.add_argument('-p','--show-progress', dest='scan_progress' , action='store_true', help="Display progression") 
-    
-    
-def action_scan(args, config):
 
-    start = args.scan_start
-    end   = args.scan_end
+#
+# The batch command executes a script over a single connection.
+#
+# Each line of the script is a 'read', 'write' or 'monitor' command with the
+# same arguments as on the command line, or 'wait SECONDS'. Comments start
+# with '#'. For example:
+#
+#    read @h30000 
+#    read h30010
+#    write h42000_1=0x55BB
+#    wait 2.5
+#    monitor -c 10 -p 1 -P @h30000
+#
+# Consecutive read commands go through the read planner together so
+# adjacent ranges are read using a single request. 
+#
+
+# An ArgumentParser that raises ValueError instead of exiting
+class BatchArgumentParser(argparse.ArgumentParser):
+
+    def error(self, message):
+        raise ValueError(message)
+
+def add_command_batch(subparsers):
+    sp = subparsers.add_parser('batch', help='Execute a script of commands over a single connection')
+    sp.add_argument('batch_file', metavar='FILE', nargs='?', default='-', help='the script or - for stdin (default)')
+
+def action_batch(args, session):
+
+    parser = BatchArgumentParser(prog='batch', add_help=False)
+    subparsers = parser.add_subparsers(dest='command')
+    add_command_read(subparsers)
+    add_command_write(subparsers)
+    add_command_monitor(subparsers)
+    sp = subparsers.add_parser('wait', help='Wait for some time')    
+    sp.add_argument('wait_seconds', metavar='SECONDS', type=float)
+
+    # Parse the whole script, its read specifications and its assignments
+    # before connecting 
+    commands = []
+    if args.batch_file == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.batch_file) as f:
+            lines = f.readlines()
+    for lineno, line in enumerate(lines, 1):
+        try:
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            cmd = parser.parse_args(words)
+            if cmd.command == 'read':
+                session.plan(cmd.read_speclist)
+            elif cmd.command == 'monitor':
+                session.plan(cmd.monitor_speclist)
+            elif cmd.command == 'write':
+                for assign in cmd.write_list:
+                    session.write_target(*parse_assignment(assign))
+            commands.append( (lineno, cmd) )
+        except Exception as e:
+            print(f"Error: line {lineno}: {e}")
+            sys.exit(1)
+
+    session.connect()
+    try:
+        k=0
+        while k < len(commands):
+            lineno, cmd = commands[k]
+            with TRACE.span(f'line {lineno}', 'batch', command=cmd.command):
+                if cmd.command == 'read':
+                    group = [ cmd ]
+                    while k+1 < len(commands) and commands[k+1][1].command == 'read':
+                        k=k+1
+                        group.append( commands[k][1] )
+                    plans = [ session.plan(c.read_speclist) for c in group ]
+                    for c, values in zip(group, session.execute_many(plans)):
+                        print_values(values, {}, show_spec=c.read_show_spec)
+                elif cmd.command == 'write':
+                    write_assignments(session, cmd.write_list, cmd.write_force)
+                elif cmd.command == 'monitor':
+                    run_monitor(cmd, session)
+                elif cmd.command == 'wait':
+                    TRACE.sleep(cmd.wait_seconds)
+            k=k+1
+    finally:
+        if args.stats:
+            STATS.report()
+    session.close()
+
+
+#
+# The peek command displays values from the register image (see --image)
+# without any Modbus request. 
+#
+def add_command_peek(subparsers):
+    sp = subparsers.add_parser('peek', help='Read registers from the register image (see --image)')    
+    sp.add_argument('peek_speclist', metavar='SPEC', nargs='+', help='read specification')
+    sp.add_argument('-S', '--show-spec', dest='peek_show_spec', action='store_true')
+    sp.add_argument('-T', '--show-time', dest='peek_show_time', action='store_true', help='Show the time of the last update')
+
+def action_peek(args, session):
+
+    if not args.image:
+        print("Error: The peek command requires --image")
+        sys.exit(1)
+
+    image = RegisterImage()
+    image.open(args.image)
+
+    plan = session.plan(args.peek_speclist)
+    ranges = plan.ranges + plan.hidden
+    snapshot = image.snapshot( [ (rg.start, rg.count) for rg in ranges ] )
+
+    values = []
+    for rg, (rvalues, times, flags) in zip(ranges, snapshot):
+        timestamp = min(times)
+        if all( flag & IMAGE_VALID for flag in flags ):
+            elems = rg.decode(rvalues)
+        else:
+            elems = [ ( rg.count, 'INVALID', '?' ) ]
+        address = rg.start
+        for elem in elems:
+            name = f"{rg.kind}{address}_{elem[0]}.{elem[2]}"
+            session.values[name] = elem[1]
+            if rg not in plan.hidden:
+                values.append( ModbusValue(name, elem[1], rg.name(), session.comments.get(name), timestamp) )
+            address = address + elem[0]
+
+    for name in plan.evaluated:
+        session.values[name] = session.virtuals[name].evaluate(session.values)
+    timestamp = time.time()
+    for name in plan.virtuals:
+        values.append( ModbusValue(name, session.values[name], None, session.comments.get(name), timestamp) )
+
+    print_values(values, {}, show_spec=args.peek_show_spec, show_time=args.peek_show_time)
+
+
+def add_command_scan(subparsers):
+    
+    sp = subparsers.add_parser('scan', help='Scan for readable registers')
+    sp.add_argument('scan_start', metavar='START', type=int, help='start address')
+    sp.add_argument('scan_end'  , metavar='END',   type=int, help='end address')
+    sp.add_argument('scan_step' , metavar='STEP',  type=int, nargs='?', default=10, help='step between addresses (default 10)')
+    sp.add_argument('-y','--yaml', dest='scan_yaml' , action='store_true', help="produce YAML configuration file") 
+    sp.add_argument('-Y','--yaml-all', dest='scan_yaml_all' , action='store_true', help="produce more YAML") 
+    sp.add_argument('-p','--show-progress', dest='scan_progress' , action='store_true', help="Display progression") 
+    sp.add_argument('-k','--classify', dest='scan_classify' , action='store_true', help="Classify the volatility of the registers found") 
+    sp.add_argument('--samples', dest='scan_samples' , metavar='INT', type=int, default=6, help="Number of samples for --classify (default 6)") 
+    sp.add_argument('--window', dest='scan_window' , metavar='SECONDS', type=float, default=30.0, help="Sampling window for --classify (default 30)") 
+    sp.add_argument('--state', dest='scan_state' , metavar='FILE', help="Save the progress in FILE and resume from it") 
+    
+
+#
+# Volatility classes for 'scan --classify' from the least to the most volatile.
+# 
+# The value is a tupple (LETTER, POLL) where
+#   - LETTER is used to summarize the classes of a block
+#   - POLL is the suggested polling period in seconds when it cannot be
+#     derived from the observed changes (see suggest_poll) 
+#
+VOLATILITY = {
+    'zero':     ( 'Z', 3600 ),  # always zero
+    'constant': ( 'C', 600 ),   # never changed
+    'slow':     ( 'S', None ),  # changed in less than half of the samples
+    'fast':     ( 'F', 1 ),     # changed in at least half of the samples
+}
+
+def classify_volatility(samples):
+    if all( v==0 for v in samples ):
+        return 'zero'
+    changes = sum( 1 for a,b in zip(samples, samples[1:]) if a!=b )
+    if changes == 0:
+        return 'constant'
+    elif 2*changes < len(samples)-1:
+        return 'slow'
+    else:
+        return 'fast'
+
+#
+# Return the suggested polling period in seconds of a register sampled at 
+# regular intervals over window seconds. 
+#
+# That is the average time between two observed changes. A register that 
+# changed at every sample may change faster than it was sampled so it gets
+# the 'fast' period. A register that never changed gets the period of its
+# class.
+#
+def suggest_poll(samples, window):
+    changes = sum( 1 for a,b in zip(samples, samples[1:]) if a!=b )
+    if changes == 0:
+        return VOLATILITY[classify_volatility(samples)][1]
+    if changes == len(samples)-1:
+        return VOLATILITY['fast'][1]
+    return max(1, int(window/changes))
+
+#
+# Sample each block (a list of (START,COUNT)) several times over a window 
+# and return a list of (CLASSES, POLL) where CLASSES are the volatility 
+# classes of the registers of the block and POLL is the suggested polling
+# period of the block (the smallest of its registers). 
+#
+# Blocks that fail to be read during the sampling are classified as 'fast'
+# so that they are never polled too slowly.  
+#
+def sample_volatility(client, blocks, samples, window):
+    values = [ [ [] for i in range(count) ] for at,count in blocks ]
+    cadence = Cadence(window/(samples-1))
+    for k in range(samples):
+        if k > 0:
+            cadence.wait()
+        with TRACE.span(f'sample {k+1}', 'scan'):
+            for (at,count), regs in zip(blocks, values):
+                r = read_holding_registers(client, at, count)
+                if r.isError():
+                    continue
+                for i in range(count):
+                    regs[i].append(r.registers[i])
+    out = []
+    for regs in values:
+        if all( len(v)==samples for v in regs ):
+            classes = [ classify_volatility(v) for v in regs ]
+            poll    = min( suggest_poll(v, window) for v in regs )
+        else:
+            classes = [ 'fast' ] * len(regs)
+            poll    = VOLATILITY['fast'][1]
+        out.append( (classes, poll) )
+    return out
+
+#
+# The state of a scan that can be performed one request at a time (see
+# step) and saved in a JSON file to be resumed later (see --state and 
+# --background-scan). 
+#
+# The registers are probed as by the scan command: a block is extended 
+# one register at a time until a read fails, then the scan continues at 
+# the next multiple of step.
+#
+class ScanState:
+
+    def __init__(self, start, end, step):
+        self.start    = start
+        self.end      = end
+        self.step     = step
+        self.at       = start  # address of the block being probed
+        self.count    = 0      # number of registers found at that address so far
+        self.blocks   = []     # list of (START, COUNT) found so far
+        self.previous = None   # blocks found by the last complete pass
+        self.passes   = 0      # number of complete passes
+        self.finished = None   # time.time() when the last pass was complete
+        self.requests = 0
+        self.stats    = None   # where the requests are recorded (default STATS)
+
+    def done(self):
+        return self.at >= self.end
+
+    #
+    # Perform one read request and return the (START, COUNT) of the block
+    # when it is complete or None.
+    #
+    def probe(self, client):
+        with TRACE.span(f'probe h{self.at}_{self.count+1}', 'scan'):
+            r = read_holding_registers(client, self.at, self.count+1, self.stats,
+                                       'scan' if self.stats else None)
+        self.requests = self.requests + 1
+        if not r.isError() and self.at+self.count < self.end:
+            self.count = self.count + 1
+            return None
+        found = None
+        if self.count > 0:
+            found = (self.at, self.count)
+            self.blocks.append(found)
+        self.at = self.at + self.count + 1
+        if self.at % self.step > 0:
+            self.at = (self.at//self.step)*self.step + self.step
+        self.count = 0
+        return found
+
+    # Start a new pass (after a complete one) 
+    def restart(self):
+        self.previous = self.blocks
+        self.blocks = []
+        self.passes = self.passes + 1
+        self.finished = time.time()
+        self.at = self.start
+        self.count = 0
+
+    def save(self, filename):
+        data = { name: getattr(self, name) for name in
+                 ('start', 'end', 'step', 'at', 'count', 'blocks', 'previous', 'passes', 'finished', 'requests') }
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def load(filename):
+        with open(filename) as f:
+            data = json.load(f)
+        state = ScanState(data['start'], data['end'], data['step'])
+        for name in ('at', 'count', 'passes', 'finished', 'requests'):
+            setattr(state, name, data[name])
+        state.blocks = [ tuple(b) for b in data['blocks'] ]
+        if data['previous'] is not None:
+            state.previous = [ tuple(b) for b in data['previous'] ]
+        return state
+
+
+#
+# A low priority scan performed in the idle time of the polling loops
+# (see VenusSession.use_idle_time) with the global --background-scan.
+#
+# A request is only sent when the time left before the next deadline is 
+# more than twice the average request latency, so the scan pauses when 
+# the polling needs the time. The state is saved when a block is found, 
+# at most every 30s otherwise and when the session is closed.
+#
+# When a pass is complete, the blocks that appeared or disappeared since
+# the previous pass are logged and a new pass starts after a while.
+#
+# A Modbus error (e.g. a timeout) during a probe is logged and pauses the
+# scan (for longer after each consecutive error) instead of interrupting 
+# the polling loop.
+#
+BACKGROUND_SCAN = ( 0, 65535, 10 )   # START, END, STEP of a new background scan
+BACKGROUND_SAVE_INTERVAL = 30.0      # seconds
+BACKGROUND_PASS_INTERVAL = 3600.0    # seconds between the end of a pass and the next one
+BACKGROUND_RETRY_MIN = 10.0          # seconds of pause after a Modbus error 
+BACKGROUND_RETRY_MAX = 600.0
+
+class BackgroundScan:
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename):
+            self.state = ScanState.load(filename)
+            log.info(f"Background scan resumed at h{self.state.at} (pass {self.state.passes+1})")
+        else:
+            self.state = ScanState(*BACKGROUND_SCAN)
+            log.info(f"Background scan started from h{self.state.start} to h{self.state.end}")
+        self.state.stats = SCAN_STATS
+        self.saved = time.monotonic()
+        self.paused_until = None   # time.monotonic() after a Modbus error
+        self.retry = BACKGROUND_RETRY_MIN
+
+    def run(self, client, deadline):
+        state = self.state
+        if state.at == state.start and state.finished is not None \
+           and time.time() < state.finished + BACKGROUND_PASS_INTERVAL:
+            return
+        if self.paused_until is not None and time.monotonic() < self.paused_until:
+            return
+        while True:
+            latency = STATS.total.latency_avg() or 0.2
+            if deadline - time.monotonic() <= 2*latency:
+                break
+            try:
+                found = state.probe(client)
+            except ModbusException as e:
+                log.warning(f"Background scan failed at h{state.at}: {e}. Pausing for {self.retry:g}s")
+                self.paused_until = time.monotonic() + self.retry
+                self.retry = min(2*self.retry, BACKGROUND_RETRY_MAX)
+                break
+            self.paused_until = None
+            self.retry = BACKGROUND_RETRY_MIN
+            if found and state.previous is None:
+                log.info(f"Background scan found h{found[0]}_{found[1]}")
+            if state.done():
+                self.complete()
+                self.save()
+                break
+            if found or time.monotonic() - self.saved > BACKGROUND_SAVE_INTERVAL:
+                self.save()
+
+    def complete(self):
+        state = self.state
+        log.info(f"Background scan pass {state.passes+1} complete: "
+                 f"{len(state.blocks)} blocks in {state.requests} requests")
+        if state.previous is not None:
+            for block in sorted(set(state.blocks) - set(state.previous)):
+                log.warning(f"Background scan: new block h{block[0]}_{block[1]}")
+            for block in sorted(set(state.previous) - set(state.blocks)):
+                log.warning(f"Background scan: missing block h{block[0]}_{block[1]}")
+        state.restart()
+
+    def save(self):
+        try:
+            self.state.save(self.filename)
+        except OSError as e:
+            log.error(f"Cannot save the background scan state: {e}")
+        self.saved = time.monotonic()
+
+
+def action_scan(args, session):
+
+    start = args.scan_start
+    end   = args.scan_end
     step  = args.scan_step
     yaml_all  = args.scan_yaml_all
     yaml  = args.scan_yaml or yaml_all
     progress  = args.scan_progress
+    classify  = args.scan_classify
+    samples   = args.scan_samples
+    window    = args.scan_window
 
     next_progress = -1
     
@@ -712,64 +2267,732 @@ def action_scan(args, config):
     if step<=0:
         print(f"Illegal step register")
         sys.exit(1)
+
+    if classify and (samples<2 or window<=0):
+        print(f"Illegal --samples or --window. Need at least 2 samples over a positive window")
+        sys.exit(1)
+
+    state = ScanState(start, end, step)
+    if args.scan_state and os.path.exists(args.scan_state):
+        try:
+            state = ScanState.load(args.scan_state)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: Cannot load the scan state {args.scan_state}: {e}")
+            sys.exit(1)
+        if (state.start, state.end, state.step) != (start, end, step):
+            print(f"Error: {args.scan_state} is a scan from {state.start} to {state.end} step {state.step}")
+            sys.exit(1)
         
     # YAML indentation
     yam1=' '*(YAML_INDENT*1)
     yam2=' '*(YAML_INDENT*2)
         
-    client = modbus_connect(config)
+    client = session.connect()
 
-    config_global = config['global']
+    config_global = session.config['global']
     
     if yaml:
         print("global:")
         print(f"{yam1}host: '{config_global['host']}'")
-        print(f"{yam1}port: '{config_global['port']}'")
+        print(f"{yam1}port: {config_global['port']}")
         print("info:")
 
+    # Print the YAML description of a block 
+    def print_yaml_block(at, count, classes=None, poll=None):
+        aliases = [ '@all' ]
+        if classes:
+            block_class = max(classes, key=lambda c: list(VOLATILITY).index(c))
+            aliases.append(f'@{block_class}')
+        print(f"{yam1}h{at}_{count}.{count}u:")
+        print(f"{yam2}alias: '@h{at}'")
+        print(f"{yam2}append: [ {', '.join(repr(a) for a in aliases)} ]")
+        if classes:
+            print(f"{yam2}poll: {poll}")
+            letters = ''.join( VOLATILITY[c][0] for c in classes )
+            print(f"{yam2}# volatility: {letters} (F=fast S=slow C=constant Z=zero)")
+        if yaml_all:
+            for i in range(count):
+                comment = f"  # {classes[i]}" if classes else ''
+                print(f"{yam2}h{at+i}_1.u: 'unknown'{comment}")
+        print(flush=True)
+
+    # Report a block found by the scan
+    def found_block(at, count):
+        if not yaml:
+            print(f"# Found address={at} count={count}",flush=True)
+        elif not classify:
+            print_yaml_block(at, count)
+
     print(f"# Scan Holding Registers from {start} to {end} step {step} ")
+
+    if state.at > start:
+        print(f"# Resume at {state.at}")
+    for at, count in state.blocks:
+        found_block(at, count)
     
-    at=start
-    while at<end :
-        
-        if progress:
-            if at >= next_progress:
-                print(f"# scan progress {at}")
-                next_progress = at+500
-                
-        
-        count=0
-        r = read_holding_registers(client, at, count+1)
-        while not r.isError() and at+count<end :
-           count = count+1
-           r = read_holding_registers(client, at, count+1)
-        if count>0:
-            rcount = rcount + count
-            bcount = bcount + 1
+    try:
+        while not state.done():
+            if progress:
+                if state.at >= next_progress:
+                    print(f"# scan progress {state.at}")
+                    next_progress = state.at+500
+            found = state.probe(client)
+            if found:
+                found_block(*found)
+                if args.scan_state:
+                    state.save(args.scan_state)
+    finally:
+        # Also save after CTRL-C
+        if args.scan_state:
+            state.save(args.scan_state)
+
+    blocks = state.blocks
+    rcount = sum( count for at, count in blocks )
+    bcount = len(blocks)
+
+    if classify and blocks:
+        print(f"# Sampling {len(blocks)} blocks {samples} times over {window}s",flush=True)
+        block_classes = sample_volatility(client, blocks, samples, window)
+        for (at,count), (classes, poll) in zip(blocks, block_classes):
             if yaml:
-                print(f"{yam1}h{at}_{count}.{count}u:")
-                print(f"{yam2}alias: '@h{at}'")
-                print(f"{yam2}append: [ '@all' ]")
-                if yaml_all:
-                    for i in range(count):
-                        print(f"{yam2}h{at+i}_1.u: 'unknown'")
-                print(flush=True)
-
+                print_yaml_block(at, count, classes, poll)
             else:
-                print(f"# Found address={at} count={count}",flush=True)
-        at=at+count+1
-
-        if at % step > 0 :
-            at = (at//step)*step + step
+                letters = ''.join( VOLATILITY[c][0] for c in classes )
+                print(f"# Volatility address={at} count={count} {letters}",flush=True)
 
     if yaml:
-        print("aliases:")
+        print("alias:")
         print(f"{yam1}'@all': [ ]",flush=True)
+        if classify:
+            for name in VOLATILITY:
+                print(f"{yam1}'@{name}': [ ]",flush=True)
         print(flush=True)
 
     print(f"# Summary: Found {rcount} registers in {bcount} blocks")
             
-    client.close()
+    session.close()
+
+    if args.stats:
+        STATS.report(per_range=False)
+
+#
+# The probe-rate command estimates how often the firmware updates the
+# registers. The specs are polled as fast as possible and the interval
+# between consecutive changes of each value is measured. 
+#
+# The estimate is the median interval. It can only be as good as the
+# time needed to poll all the specs (the resolution) and a register that
+# is refreshed with the same value looks slower than it is.
+#
+# With --write-config, the recommended polling period of each block of 
+# the 'info' section is written in its 'poll' key (also used as cache TTL).
+#
+def add_command_probe_rate(subparsers):
+    sp = subparsers.add_parser('probe-rate', help='Estimate the refresh rate of registers')    
+    sp.add_argument('probe_speclist', metavar='SPEC', nargs='+', help='read specification')
+    sp.add_argument('-d', '--duration', dest='probe_duration', metavar='SECONDS', type=float, default=60.0,
+                    help='Polling duration (default 60)')
+    sp.add_argument('-w', '--write-config', dest='probe_write_config', action='store_true',
+                    help='Write the recommended polling periods into the configuration file')
+
+def action_probe_rate(args, session):
+
+    duration = args.probe_duration
+    if args.probe_write_config and not args.config:
+        print("Error: --write-config requires a configuration file (-c)")
+        sys.exit(1)
+
+    plan = session.plan(args.probe_speclist)
+    session.connect()
+
+    print(f"# Polling for {duration}s", flush=True)
+    changes  = {}   # name -> list of monotonic times
+    previous = {}
+    iterations = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        for v in session.execute(plan, cached=False):
+            if v.name in previous and previous[v.name] != v.value:
+                changes.setdefault(v.name, []).append(v.monotonic)
+            elif v.name not in previous:
+                changes[v.name] = []
+            previous[v.name] = v.value
+        iterations = iterations + 1
+    elapsed = time.monotonic() - start
+    session.close()
+
+    resolution = elapsed / max(iterations, 1)
+    print(f"# {iterations} iterations in {elapsed:.1f}s (resolution {resolution:.3f}s)")
+
+    recommended = {}  # name -> polling period
+    for name, times in changes.items():
+        intervals = sorted( b-a for a,b in zip(times, times[1:]) )
+        if len(intervals) == 0:
+            print(f"{name:12} = {len(times)} changes (interval > {elapsed:.0f}s?)")
+            continue
+        interval = intervals[len(intervals)//2]
+        jitter = sorted( abs(x-interval) for x in intervals )[len(intervals)//2]
+        poll = max(round(interval, 1), round(resolution, 1), 0.1)
+        recommended[name] = poll
+        print(f"{name:12} = {len(times)} changes interval={interval:.3f}s "
+              f"min={intervals[0]:.3f}s jitter={jitter:.3f}s poll={poll:g}")
+
+    if args.probe_write_config:
+        # A virtual register needs its physical dependencies to be polled
+        # at least as often as itself.
+        physical = {}
+        for name, poll in recommended.items():
+            deps = virtual_dependencies([name], session.virtuals) if name in session.virtuals else [name]
+            for dep in deps:
+                physical[dep] = min(physical.get(dep, poll), poll)
+        # The poll of a block is the minimum of its registers
+        polls = {}
+        for block in session.config.get('info',{}):
+            try:
+                spec = ModbusSpec.parse(block)
+            except Exception:
+                continue
+            for name, poll in physical.items():
+                rg = ModbusSpec.parse(name)
+                if spec.start <= rg.start and rg.start+rg.count <= spec.start+spec.count:
+                    polls[block] = min(polls.get(block, poll), poll)
+        set_config_polls(args.config, polls)
+        for block, poll in polls.items():
+            print(f"# Set poll: {poll:g} in {block}")
+
+#
+# Set the 'poll' key of some blocks of the 'info' section (a dict block -> poll)
+# in a YAML file. 
+#
+# The file is edited as text to preserve the comments and the layout.
+#
+def set_config_polls(filename, polls):
+    with open(filename) as f:
+        lines = f.readlines()
+    for block, poll in polls.items():
+        key = re.compile(r'^(\s*)[\'"]?' + re.escape(block) + r'[\'"]?\s*:\s*(#.*)?$')
+        for k, line in enumerate(lines):
+            m = key.match(line)
+            if m:
+                break
+        else:
+            log.warning(f"Cannot find '{block}' in {filename}")
+            continue
+        indent = len(m.group(1))
+        # Find the end of the block body and where to insert the poll key 
+        body_indent = ' '*(indent+YAML_INDENT)
+        insert = k+1
+        end = k+1
+        while end < len(lines):
+            stripped = lines[end].strip()
+            if stripped and not stripped.startswith('#'):
+                line_indent = len(lines[end]) - len(lines[end].lstrip())
+                if line_indent <= indent:
+                    break
+                body_indent = lines[end][:line_indent]
+                if re.match(r'^(alias|append)\s*:', stripped):
+                    insert = end+1
+            end = end+1
+        text = f"{body_indent}poll: {poll:g}\n"
+        for j in range(k+1, end):
+            if re.match(r'^\s*poll\s*:', lines[j]):
+                lines[j] = text
+                break
+        else:
+            lines.insert(insert, text)
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+
+#
+# The serve-metrics command polls some specifications (see PollScheduler)
+# and serves the latest values on a HTTP endpoint in the Prometheus text
+# format. A scrape never causes a Modbus request.
+#
+# Each numeric value is a gauge named after the register (e.g. 
+# venus_h32102_1_u or venus_v_stored_energy) with its comment as help.
+# Non numeric values (e.g. strings or errors) are not exported. 
+#
+# The exporter also describes itself with the venus_poll_* and 
+# venus_request_* metrics (see ModbusStats).
+#
+METRICS_PREFIX = 'venus_'
+
+def metric_name(name):
+    return METRICS_PREFIX + re.sub(r'[^A-Za-z0-9_]', '_', name)
+
+def metric_escape(text, label=False):
+    text = text.replace('\\', '\\\\').replace('\n', '\\n')
+    if label:
+        text = text.replace('"', '\\"')
+    return text
+
+class MetricsExporter:
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.lock      = threading.Lock()
+        self.values    = {}   # name -> ModbusValue
+        self.scrapes   = 0
+
+    def update(self, values):
+        with self.lock:
+            for v in values:
+                self.values[v.name] = v
+
+    # Return the metrics in the Prometheus text format.
+    def render(self):
+        with self.lock:
+            self.scrapes = self.scrapes + 1
+            values = sorted(self.values.values(), key=lambda v: v.name)
+        now = time.monotonic()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {metric_escape(help)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        for v in values:
+            number = v.number()
+            if type(number) not in (int, float):
+                continue
+            metric(metric_name(v.name), 'gauge', v.comment or v.name, [ ('', number) ])
+
+        sched = self.scheduler
+        metric(METRICS_PREFIX+'poll_age_seconds', 'gauge',
+               'Seconds since the last completed poll of each period',
+               [ (f'{{period="{g.period:g}"}}', f"{now-g.last:.3f}")
+                 for g in sched.groups if g.last is not None ])
+        metric(METRICS_PREFIX+'poll_cycles_total', 'counter', 'Number of poll cycles',
+               [ ('', sched.cycles) ])
+        metric(METRICS_PREFIX+'poll_missed_total', 'counter', 'Number of poll ticks missed by overruns',
+               [ ('', sched.missed) ])
+
+        t = STATS.total
+        metric(METRICS_PREFIX+'requests_total', 'counter', 'Number of Modbus requests',
+               [ ('', t.requests) ])
+        metric(METRICS_PREFIX+'request_errors_total', 'counter', 'Number of failed Modbus requests',
+               [ ('', t.errors) ])
+        metric(METRICS_PREFIX+'request_retries_total', 'counter', 'Number of Modbus request retries',
+               [ ('', t.retries) ])
+        metric(METRICS_PREFIX+'request_exceptions_total', 'counter', 'Number of Modbus exceptions by name',
+               [ (f'{{exception="{metric_escape(name, True)}"}}', n)
+                 for name, n in sorted(t.exceptions.items()) ])
+        metric(METRICS_PREFIX+'disconnects_total', 'counter', 'Number of connection failures',
+               [ ('', STATS.disconnects) ])
+        buckets = []
+        cumulated = 0
+        for bound, n in zip(STATS_LATENCY_BUCKETS, t.histogram):
+            cumulated = cumulated + n
+            buckets.append( (f'_bucket{{le="{bound:g}"}}', cumulated) )
+        buckets.append( ('_bucket{le="+Inf"}', t.requests) )
+        buckets.append( ('_sum', f"{t.latency:.6f}") )
+        buckets.append( ('_count', t.requests) )
+        metric(METRICS_PREFIX+'request_latency_seconds', 'histogram', 'Latency of the Modbus requests',
+               buckets)
+        if sched.session.background is not None:
+            state = sched.session.background.state
+            metric(METRICS_PREFIX+'background_scan_requests_total', 'counter',
+                   'Number of Modbus requests of the background scan (not in venus_requests_total)',
+                   [ ('', SCAN_STATS.total.requests) ])
+            metric(METRICS_PREFIX+'background_scan_blocks', 'gauge',
+                   'Number of blocks found by the last complete pass of the background scan (or so far)',
+                   [ ('', len(state.previous if state.previous is not None else state.blocks)) ])
+        metric(METRICS_PREFIX+'scrapes_total', 'counter', 'Number of scrapes',
+               [ ('', self.scrapes) ])
+        return '\n'.join(lines) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    exporter = None  # set by action_serve_metrics
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.exporter.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("HTTP %s - %s", self.address_string(), format % args)
+
+def add_command_serve_metrics(subparsers):
+    sp = subparsers.add_parser('serve-metrics', help='Poll registers and serve them as Prometheus metrics')
+    sp.add_argument('metrics_speclist', metavar='SPEC', nargs='*', default=['@all'],
+                    help='read specification (default @all)')
+    sp.add_argument('-p', '--period', dest='metrics_period', metavar='SECONDS', type=float, default=10.0,
+                    help="Polling period of the specifications without a 'poll' key (default 10)")
+    sp.add_argument('-l', '--listen', dest='metrics_listen', metavar='ADDRESS', default='127.0.0.1',
+                    help='HTTP listen address (default 127.0.0.1)')
+    sp.add_argument('-P', '--http-port', dest='metrics_port', metavar='PORT', type=int, default=9877,
+                    help='HTTP port (default 9877)')
+
+def action_serve_metrics(args, session):
+
+    if args.metrics_period <= 0:
+        print(f"Illegal period {args.metrics_period}")
+        sys.exit(1)
+
+    scheduler = PollScheduler(session, args.metrics_speclist, args.metrics_period)
+    exporter = MetricsExporter(scheduler)
+    handler = type('Handler', (MetricsHandler,), { 'exporter': exporter })
+    try:
+        server = http.server.ThreadingHTTPServer((args.metrics_listen, args.metrics_port), handler)
+    except OSError as e:
+        print(f"Error: Cannot listen on {args.metrics_listen}:{args.metrics_port}: {e}")
+        sys.exit(1)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Serving metrics on http://{args.metrics_listen}:{args.metrics_port}/metrics")
+
+    session.connect()
+    try:
+        scheduler.poll_forever(exporter.update)
+    finally:
+        server.shutdown()
+        session.close()
+
+#
+# A minimal MQTT 3.1.1 client that can only publish with QoS 0.  
+#
+# publish_many() sends all its messages with a single socket write.
+#
+MQTT_CONNECT    = 0x10
+MQTT_CONNACK    = 0x20
+MQTT_PUBLISH    = 0x30
+MQTT_PINGREQ    = 0xC0
+MQTT_DISCONNECT = 0xE0
+
+def mqtt_length(n):
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n = n // 128
+        out.append(byte | 0x80 if n > 0 else byte)
+        if n == 0:
+            return bytes(out)
+
+def mqtt_string(text):
+    data = text.encode() if type(text) is str else text
+    return len(data).to_bytes(2,'big') + data
+
+def mqtt_packet(kind, body=b''):
+    return bytes([kind]) + mqtt_length(len(body)) + body
+
+class MqttClient:
+
+    def __init__(self, host, port=1883, client_id='venus', username=None, password=None,
+                 keepalive=60, will=None):
+        self.host      = host
+        self.port      = port
+        self.client_id = client_id
+        self.username  = username
+        self.password  = password
+        self.keepalive = keepalive
+        self.will      = will   # (topic, payload) published by the broker when the connection is lost
+        self.sock      = None
+        self.last_send = 0
+
+    def connect(self):
+        flags = 0x02  # Clean session
+        payload = mqtt_string(self.client_id)
+        if self.will:
+            flags = flags | 0x24  # Will flag, retained, QoS 0
+            payload = payload + mqtt_string(self.will[0]) + mqtt_string(self.will[1])
+        if self.username is not None:
+            flags = flags | 0x80
+            payload = payload + mqtt_string(self.username)
+            if self.password is not None:
+                flags = flags | 0x40
+                payload = payload + mqtt_string(self.password)
+        body = mqtt_string('MQTT') + bytes([4, flags]) + self.keepalive.to_bytes(2,'big') + payload
+        self.sock = socket.create_connection((self.host, self.port), timeout=10)
+        self.sock.sendall(mqtt_packet(MQTT_CONNECT, body))
+        self.last_send = time.monotonic()
+        ans = b''
+        while len(ans) < 4:
+            data = self.sock.recv(4-len(ans))
+            if not data:
+                raise ConnectionError("Connection closed by the broker")
+            ans = ans + data
+        if ans[0] != MQTT_CONNACK or ans[3] != 0:
+            raise ConnectionError(f"Connection refused by the broker (code {ans[3]})")
+
+    def send(self, data):
+        self.sock.sendall(data)
+        self.last_send = time.monotonic()
+        # Discard the incoming packets (e.g. PINGRESP) 
+        self.sock.setblocking(False)
+        try:
+            while True:
+                data = self.sock.recv(4096)
+                if not data:
+                    raise ConnectionError("Connection closed by the broker")
+        except BlockingIOError:
+            pass
+        finally:
+            self.sock.settimeout(10)
+
+    #
+    # Publish a list of (TOPIC, PAYLOAD, RETAIN) and return the number of
+    # bytes sent.
+    #
+    def publish_many(self, messages):
+        data = b''.join( mqtt_packet(MQTT_PUBLISH | (0x01 if retain else 0),
+                                     mqtt_string(topic) + payload.encode())
+                         for topic, payload, retain in messages )
+        self.send(data)
+        return len(data)
+
+    # Send a PINGREQ if nothing was sent for half the keepalive period
+    def ping(self):
+        if time.monotonic() - self.last_send > self.keepalive/2:
+            self.send(mqtt_packet(MQTT_PINGREQ))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall(mqtt_packet(MQTT_DISCONNECT))
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+
+
+#
+# Publish MQTT messages from a background thread so that a slow or 
+# unreachable broker never delays the polling.
+#
+# publish() merges the messages into the pending messages (the last 
+# payload of a topic wins) so the memory is bounded by the number of 
+# topics. The thread sends all the pending messages at once. The messages
+# of the 'connect' list (e.g. the discovery) are sent after each 
+# (re)connection.
+#
+class MqttPublisher:
+
+    def __init__(self, client, connect=[], retry=10.0):
+        self.client   = client
+        self.connect  = connect
+        self.retry    = retry  # seconds between two connection attempts
+        self.lock     = threading.Lock()
+        self.event    = threading.Event()
+        self.pending  = {}     # topic -> (payload, retain)
+        self.running  = True
+        self.stopped  = threading.Event()
+        self.messages = 0
+        self.batches  = 0
+        self.sent     = 0      # bytes
+        self.thread   = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def publish(self, messages):
+        if not messages:
+            return
+        with self.lock:
+            for topic, payload, retain in messages:
+                self.pending[topic] = (payload, retain)
+        self.event.set()
+
+    def stop(self, timeout=10.0):
+        self.running = False
+        self.stopped.set()
+        self.event.set()
+        self.thread.join(timeout)
+
+    def _worker(self):
+        connected = False
+        while self.running or self.pending:
+            if not connected:
+                try:
+                    self.client.connect()
+                    self._send(list(self.connect))
+                    connected = True
+                    log.info(f"Connected to MQTT broker {self.client.host}:{self.client.port}")
+                except (OSError, ConnectionError) as e:
+                    log.warning(f"MQTT broker {self.client.host}:{self.client.port}: {e}")
+                    self.client.close()
+                    if not self.running:
+                        break
+                    self.stopped.wait(self.retry)
+                    continue
+            self.event.wait(self.client.keepalive/2)
+            self.event.clear()
+            with self.lock:
+                messages = [ (topic, payload, retain) for topic, (payload, retain) in self.pending.items() ]
+                self.pending = {}
+            try:
+                if messages:
+                    self._send(messages)
+                else:
+                    self.client.ping()
+            except (OSError, ConnectionError) as e:
+                log.warning(f"MQTT broker {self.client.host}:{self.client.port}: {e}")
+                self.client.close()
+                connected = False
+                # Keep the messages unless they were replaced meanwhile
+                with self.lock:
+                    for topic, payload, retain in messages:
+                        self.pending.setdefault(topic, (payload, retain))
+        self.client.close()
+
+    def _send(self, messages):
+        if messages:
+            self.sent = self.sent + self.client.publish_many(messages)
+            self.messages = self.messages + len(messages)
+            self.batches = self.batches + 1
+
+
+#
+# The publish command polls some specifications (see PollScheduler) and 
+# publishes the values that changed to a MQTT broker, in one batch per 
+# poll cycle, from a background thread (see MqttPublisher). 
+#
+# The value of a register (e.g. 'h30000_1.u') or of a virtual register is
+# published (retained) on '<PREFIX>/<NAME>' where NAME is the name with
+# the '.' replaced by '_' (e.g. 'venus/h30000_1_u'). The topic 
+# '<PREFIX>/status' is 'online' or 'offline'.
+#
+# Unless disabled, a retained Home Assistant discovery message is also 
+# published for each value. Its name is the comment of the value. The unit
+# and the scale are taken from the end of the comment (e.g. '(0.1V)', 
+# '(1/100 kWh)' or '(W)') when the unit is one of MQTT_UNITS and the scale
+# is a positive decimal or '1/N'. The values with a numeric format ('u', 'i', 'U' or 'I') and the
+# virtual registers are measurements, except the energies that are totals
+# (Home Assistant rejects an energy sensor with the 'measurement' state 
+# class). 
+#
+MQTT_NUMERIC_FORMATS = 'uiUI'
+
+MQTT_DEVICE_CLASSES = {
+    'V'  : 'voltage',
+    'A'  : 'current',
+    'W'  : 'power',
+    'Wh' : 'energy',
+    'kWh': 'energy',
+    '°C' : 'temperature',
+    'Hz' : 'frequency',
+    'mV' : 'voltage',
+    'mA' : 'current',
+}
+
+MQTT_UNITS = set(MQTT_DEVICE_CLASSES) | { '%', 'dBm', 'VA', 'var', 's', 'min', 'h' }
+
+MQTT_UNIT_PATTERN = re.compile(r'\(\s*(1/[1-9][0-9]*|[0-9]*\.?[0-9]+)?\s*([^()0-9.\s][^()]*?)\s*\)\s*$')
+
+#
+# Return the (SCALE, UNIT) found at the end of a comment or None. SCALE is
+# a float or None.
+#
+def mqtt_unit(comment):
+    m = MQTT_UNIT_PATTERN.search(comment or '')
+    if not m or m.group(2) not in MQTT_UNITS:
+        return None
+    scale, unit = m.group(1), m.group(2)
+    if scale is None:
+        return None, unit
+    if scale.startswith('1/'):
+        scale = 1/int(scale[2:])
+    else:
+        scale = float(scale)
+    if scale <= 0:
+        return None
+    return scale, unit
+
+def mqtt_object_id(name):
+    return re.sub(r'[^A-Za-z0-9_]', '_', name)
+
+# Return the Home Assistant discovery (TOPIC, PAYLOAD) of a value 
+def mqtt_discovery(name, comment, virtual, prefix, discovery):
+    object_id = mqtt_object_id(name)
+    node_id = mqtt_object_id(prefix)
+    config = {
+        'name'               : comment or name,
+        'unique_id'          : f"{node_id}_{object_id}",
+        'object_id'          : f"{node_id}_{object_id}",
+        'state_topic'        : f"{prefix}/{object_id}",
+        'availability_topic' : f"{prefix}/status",
+        'device'             : { 'identifiers': [ node_id ], 'name': 'Marstek Venus', 'manufacturer': 'Marstek' },
+    }
+    if virtual or name.split('.')[-1] in MQTT_NUMERIC_FORMATS:
+        config['state_class'] = 'measurement'
+        found = mqtt_unit(comment)
+        if found:
+            scale, unit = found
+            config['unit_of_measurement'] = unit
+            if unit in MQTT_DEVICE_CLASSES:
+                config['device_class'] = MQTT_DEVICE_CLASSES[unit]
+                if config['device_class'] == 'energy':
+                    # Not always increasing (e.g. the energy stored in the battery)
+                    config['state_class'] = 'total'
+            if scale is not None and scale != 1:
+                config['value_template'] = f"{{{{ (value | float * {scale:g}) | round(3) }}}}"
+    return ( f"{discovery}/sensor/{node_id}/{object_id}/config", json.dumps(config) )
+
+def add_command_publish(subparsers):
+    sp = subparsers.add_parser('publish', help='Poll registers and publish the changes to a MQTT broker')
+    sp.add_argument('publish_speclist', metavar='SPEC', nargs='*', default=['@all'],
+                    help='read specification (default @all)')
+    sp.add_argument('-p', '--period', dest='publish_period', metavar='SECONDS', type=float, default=10.0,
+                    help="Polling period of the specifications without a 'poll' key (default 10)")
+    sp.add_argument('-b', '--broker', dest='publish_broker', metavar='HOST', default='localhost',
+                    help='MQTT broker (default localhost)')
+    sp.add_argument('--broker-port', dest='publish_broker_port', metavar='PORT', type=int, default=1883,
+                    help='MQTT broker port (default 1883)')
+    sp.add_argument('-u', '--username', dest='publish_username')
+    sp.add_argument('--password', dest='publish_password')
+    sp.add_argument('--client-id', dest='publish_client_id', default='venus')
+    sp.add_argument('-t', '--topic', dest='publish_topic', metavar='PREFIX', default='venus',
+                    help='Topic prefix (default venus)')
+    sp.add_argument('--discovery', dest='publish_discovery', metavar='PREFIX', default='homeassistant',
+                    help="Home Assistant discovery prefix (default homeassistant) or '' to disable")
+
+def action_publish(args, session):
+
+    if args.publish_period <= 0:
+        print(f"Illegal period {args.publish_period}")
+        sys.exit(1)
+
+    prefix = args.publish_topic.rstrip('/')
+    status = f"{prefix}/status"
+    scheduler = PollScheduler(session, args.publish_speclist, args.publish_period)
+
+    connect = []
+    if args.publish_discovery:
+        for group in scheduler.groups:
+            for name in group.plan.names():
+                connect.append( mqtt_discovery(name, session.comments.get(name), name in session.virtuals,
+                                               prefix, args.publish_discovery) + (True,) )
+    connect.append( (status, 'online', True) )
+
+    client = MqttClient(args.publish_broker, args.publish_broker_port, args.publish_client_id,
+                        args.publish_username, args.publish_password, will=(status, 'offline'))
+    publisher = MqttPublisher(client, connect)
+
+    previous = {}  # name -> last published value
+
+    # Publish the values that changed 
+    def publish_changes(values):
+        messages = []
+        for v in values:
+            if previous.get(v.name) != v.value:
+                previous[v.name] = v.value
+                messages.append( (f"{prefix}/{mqtt_object_id(v.name)}", str(v.value), True) )
+        publisher.publish(messages)
+
+    session.connect()
+    try:
+        scheduler.poll_forever(publish_changes)
+    finally:
+        publisher.publish([ (status, 'offline', True) ])
+        publisher.stop()
+        session.close()
+        log.info(f"Published {publisher.messages} MQTT messages in {publisher.batches} batches ({publisher.sent} bytes)")
 
 #
 # The test action does nothing except connect & disconnect.
@@ -779,10 +3002,10 @@ def action_scan(args, config):
 def add_command_aliases(subparsers):
     sp = subparsers.add_parser('aliases', help='List all aliases')
 
-def action_aliases(args, config):
+def action_aliases(args, session):
 
-    for name in sorted(ALIASES.keys()):
-        value = ALIASES[name]
+    for name in sorted(session.aliases.keys()):
+        value = session.aliases[name]
         if type(value) is str:
             print(f"{name:10} = '{value}'")
         else:
@@ -796,21 +3019,15 @@ def action_aliases(args, config):
 def add_command_test(subparsers):
     sp = subparsers.add_parser('test', help='TEST')
 
-def action_test(args, config):
-    client = modbus_connect(config)
+def action_test(args, session):
+    client = session.connect()
 
     if client.connected:
         print('OK: Connected')
         
-    client.close()
+    session.close()
     
 
-def parse_arguments():
-    
-        
-    return args
-
-
 # Validate a configurate created with yamale.make_data()
 def validate_config(what, data):
 
@@ -830,11 +3047,8 @@ def validate_config(what, data):
     try :
         yamale.validate( YAMALE_SCHEMA, data)
     except yamale.yamale_error.YamaleError as e:
-        log.error(' Validation of %s failed',what)
-        for result in e.results:
-            for error in result.errors:
-                log.error(" %s",error)
-            sys.exit(1)
+        errors = [ error for result in e.results for error in result.errors ]
+        raise ValueError(f"Validation of {what} failed:\n  " + "\n  ".join(errors))
 
     return data[0][0]
 
@@ -894,8 +3108,7 @@ def expand_specifications(specs, aliases):
                 if spec in aliases:
                     return _rec_expand(out, aliases[spec], seen)
                 else:
-                    log.error(f'Unknown alias {spec}')
-                    sys.exit(1)
+                    raise ValueError(f'Unknown alias {spec}')
             else:
                 out.append(spec)
         elif type(spec) is list:
@@ -962,9 +3175,479 @@ def get_all_aliases(config):
     return expanded_aliases
 
 
+#
+# Return the sorted list of (START, COUNT) of the holding register blocks 
+# described in config['info'] (see prefetch_requests). 
+#
+def get_known_blocks(config):
+    blocks = set()
+    for block in config.get('info',{}):
+        try:
+            spec = ModbusSpec.parse(block)
+        except Exception:
+            continue
+        if spec.kind == 'h':
+            blocks.add( (spec.start, spec.count) )
+    return sorted(blocks)
+
+#
+# Return the list of (START, COUNT) of the blocks found by a scan (i.e. the
+# '# Found address=30000 count=8' lines of its output).
+#
+SCAN_FOUND_PATTERN = re.compile(r'^# Found address=(\d+) count=(\d+)')
+
+def load_scan_map(filename):
+    blocks = []
+    with open(filename) as f:
+        for line in f:
+            m = SCAN_FOUND_PATTERN.match(line)
+            if m:
+                blocks.append( (int(m.group(1)), int(m.group(2))) )
+    return blocks
+
+#
+# Return a list of (START, COUNT, VALUE) for the blocks of config['info']
+# that have a numeric key (e.g. 'poll' or 'write_interval').
+#
+def get_block_settings(config, key):
+    out = []
+    for block, value in config.get('info',{}).items():
+        if type(value) is not dict or type(value.get(key)) not in (int,float):
+            continue
+        try:
+            spec = ModbusSpec.parse(block)
+        except Exception:
+            log.warning(f"Ignoring '{key}' in '{block}' (not a read specification)")
+            continue
+        out.append( (spec.start, spec.count, value[key]) )
+    return out
+
+#
+# Load, validate and complete a configuration.
+#
+#  - config : a YAML filename, an already parsed dict or None for the default configuration
+#
+def load_config(config=None, host=None, port=None):
+
+    if config is None:
+        what   = 'YAMALE_DEFAULT_CONFIG'
+        config_data = YAMALE_DEFAULT_CONFIG
+    elif type(config) is dict:
+        what   = 'config'
+        config_data = [ (config, None) ]
+    else:
+        what   = config
+        config_data = yamale.make_data(config)
+
+    # Copy so that neither YAMALE_DEFAULT_CONFIG nor the dict of the caller
+    # is modified (e.g. by the host and the port below)
+    config = copy.deepcopy( validate_config( what, config_data ) )
+
+    config['global'] = config.get('global', {} )
+    config_global = config['global']
+    config_global['host'] = host or config_global.get('host', DEFAULT_HOSTNAME)
+    config_global['port'] = port or config_global.get('port', DEFAULT_PORT)
+
+    return config
+
+
+#
+# A decoded value as returned by VenusSession.read() and VenusSession.monitor()
+#
+class ModbusValue:
+
+    def __init__(self, name, value, spec=None, comment=None, timestamp=None, monotonic=None):
+        self.name      = name       # e.g. 'h30001_1.i' or a virtual register name
+        self.value     = value      # textual representation (as displayed by read)
+        self.spec      = spec       # name of the read spec or None for virtual registers 
+        self.comment   = comment    # from the YAML config or None
+        self.timestamp = timestamp  # time.time() when the response was received 
+        self.monotonic = monotonic  # time.monotonic() when the response was received
+
+    def __repr__(self):
+        return f"ModbusValue<{self.name}={self.value}>"
+
+    # The value as a number when possible (else the text)  
+    def number(self):
+        return virtual_number(self.value)
+
+
+#
+# What must be read and computed for a list of specifications after 
+# expanding the aliases.
+#
+# The virtual registers dependencies are read without being returned when
+# they are not already produced by the requested specs. The same goes for 
+# the extra names (registers or virtual registers) that are needed by the
+# caller (e.g. for the triggers). 
+#
+class ReadPlan:
+
+    def __init__(self, speclist, virtuals, extra=[]):
+
+        self.virtuals = [ spec for spec in speclist if spec in virtuals ]
+        self.ranges = [ ModbusSpec.parse(spec) for spec in speclist if spec not in virtuals ]
+        self.hidden = []
+
+        needed_virtuals = self.virtuals + [ name for name in extra if name in virtuals ]
+        needed_physical = [ name for name in extra if name not in virtuals ]
+        needed_physical = needed_physical + virtual_dependencies(needed_virtuals, virtuals)
+        if needed_physical:
+            produced = set()
+            for rg in self.ranges:
+                produced.update(rg.elem_names())
+            for dep in needed_physical:
+                if dep not in produced:
+                    rg = ModbusSpec.parse(dep)
+                    self.hidden.append(rg)
+                    produced.update(rg.elem_names())
+
+        # Evaluate in dependency order (see get_all_virtuals) including
+        # the virtual registers that are only needed by other ones.
+        needed = set(needed_virtuals)
+        for name in reversed(list(virtuals.keys())):
+            if name in needed:
+                needed.update( dep for dep in virtuals[name].deps if dep in virtuals )
+        self.evaluated = [ name for name in virtuals if name in needed ]
+
+        self.requests = plan_requests(self.ranges + self.hidden)
+
+    # The names of the values returned by VenusSession.execute() 
+    def names(self):
+        return [ name for rg in self.ranges for name in rg.elem_names() ] + self.virtuals
+
+
+#
+# A reusable session holding the connection, the configuration, the
+# aliases, the comments and the decode plans.
+#
+# This is the entry point when modbus.py is imported as a library: 
+#
+#    import modbus
+#
+#    with modbus.VenusSession('config_venus3.yaml', host='192.168.0.99') as session:
+#        for v in session.read(['@h30000', 'v_stored_energy']):
+#            print(v.name, v.number(), v.comment)
+#        session.write('h42000_1', 0x55BB)
+#
+# With prefetch, the reads are widened to the known blocks (see
+# prefetch_requests) and read() uses the fresh values of the cache.
+#
+class VenusSession:
+
+    def __init__(self, config=None, host=None, port=None, marstek_fix=True, prefetch=False):
+        self.config = load_config(config, host, port)
+        self.marstek_fix = marstek_fix
+        self.prefetch = prefetch
+        self.blocks = get_known_blocks(self.config)
+
+        self.comments = {}
+        populate_comments( self.comments, self.config.get('info',{}) )
+
+        self.aliases = get_all_aliases(self.config)
+
+        self.virtuals = get_all_virtuals(self.config)
+        for name, virtual in self.virtuals.items():
+            if virtual.info:
+                self.comments[name] = virtual.info
+
+        self.triggers = get_all_triggers(self.config, self.virtuals)
+        self.runner   = TriggerRunner()
+
+        config_global = self.config['global']
+        self.cache = RegisterCache(config_global.get('cache_ttl', DEFAULT_CACHE_TTL))
+        for start, count, poll in get_block_settings(self.config, 'poll'):
+            self.cache.set_ttl(start, count, poll)
+
+        self.suppress_ttl = config_global.get('suppress_ttl', DEFAULT_SUPPRESS_TTL)
+        self.write_interval = config_global.get('write_interval', DEFAULT_WRITE_INTERVAL)
+        self.write_intervals = get_block_settings(self.config, 'write_interval')
+        self.pending_writes = {}  # address -> (dest, values) 
+        self.last_writes = {}     # address -> monotonic time of the last write
+
+        self.background = None  # BackgroundScan (see use_idle_time)
+
+        self.client  = None
+        self.plans   = {}    # tuple of specs -> ReadPlan
+        self.values  = {}    # name -> last decoded value (str) 
+        self.cadence = None  # Cadence of the current monitor() 
+        self.missed  = 0     # ticks missed before the current monitor() iteration 
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Connect if not already connected and return the pymodbus client.
+    def connect(self):
+        if self.client is None:
+            self.client = modbus_connect(self.config, self.marstek_fix)
+        return self.client
+
+    def close(self):
+        if self.background is not None:
+            self.background.save()
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        self.runner.stop()
+
+    # Evaluate the triggers with the current values. 
+    def check_triggers(self):
+        now = time.monotonic()
+        for trigger in self.triggers.values():
+            value = self.values.get(trigger.value)
+            if value is None or value == '?':
+                # Not read or not computable in this iteration
+                continue
+            event = trigger.update(virtual_number(value), now)
+            if event:
+                self.runner.submit(trigger, event)
+
+    # Use the time left before a deadline (time.monotonic()) for the background scan
+    def use_idle_time(self, deadline):
+        if self.background is not None:
+            self.background.run(self.connect(), deadline)
+
+    # Add known blocks, e.g. from a scan (see load_scan_map) 
+    def add_blocks(self, blocks):
+        self.blocks = sorted(set(self.blocks) | set(blocks))
+
+    #
+    # Return the (cached) ReadPlan for a spec or a list of specs.
+    #
+    # The extra names are also read or computed but not returned (see ReadPlan).
+    #
+    def plan(self, specs, extra=[]):
+        if type(specs) is str:
+            specs = [ specs ]
+        key = ( tuple(specs), tuple(extra) )
+        if key not in self.plans:
+            speclist = expand_specifications( list(specs), self.aliases)
+            self.plans[key] = ReadPlan(speclist, self.virtuals, extra)
+        return self.plans[key]
+
+    #
+    # Read all the registers of a plan and compute its virtual registers. 
+    #
+    # Return a list of ModbusValue for the requested specs.
+    #
+    # With cached, the ranges whose registers are all fresh in the cache are
+    # not read. The default is to use the cache when prefetch is enabled.
+    #
+    def execute(self, plan, cached=None):
+        return self.execute_many([plan], cached)[0]
+
+    #
+    # Same as execute() for multiple plans but all the requests go through the
+    # read planner together so adjacent ranges from different plans are merged. 
+    #
+    # Return a list of results (one per plan).  
+    #
+    def execute_many(self, plans, cached=None):
+        client = self.connect()
+        if cached is None:
+            cached = self.prefetch
+        ranges = [ rg for plan in plans for rg in plan.ranges + plan.hidden ]
+
+        results = {}
+        if cached:
+            now = time.monotonic()
+            for rg in ranges:
+                registers = self.cache.get(rg.start, rg.count, now) if rg.kind == 'h' else None
+                if registers is not None:
+                    monotonic = self.cache.values[rg.start][1]
+                    results[rg] = ( rg.decode(registers), time.time() - (now - monotonic), monotonic )
+
+        if len(plans) == 1 and not results:
+            requests = plans[0].requests
+        else:
+            requests = plan_requests([ rg for rg in ranges if rg not in results ])
+        if self.prefetch:
+            requests = prefetch_requests(requests, self.blocks)
+        results.update(execute_requests(client, requests, self.cache))
+
+        outs = []
+        for plan in plans:
+            out = []
+            for rg in plan.ranges + plan.hidden:
+                visible = rg not in plan.hidden
+                kind    = rg.kind
+                address = rg.start
+                elems, timestamp, monotonic = results[rg]
+                if any( elem[2] == '?' for elem in elems ):
+                    # Failed read: forget the previous values of that range so
+                    # that the virtual registers and triggers do not use them.
+                    for name in rg.elem_names():
+                        self.values.pop(name, None)
+                for elem in elems:
+                    name = f"{kind}{address}_{elem[0]}.{elem[2]}"
+                    value = elem[1]
+                    self.values[name] = value
+                    if visible:
+                        out.append( ModbusValue(name, value, rg.name(), self.comments.get(name),
+                                                timestamp, monotonic) )
+                    address = address + elem[0]
+
+            if plan.evaluated:
+                with TRACE.span('virtual', 'decode'):
+                    for name in plan.evaluated:
+                        self.values[name] = self.virtuals[name].evaluate(self.values)
+                timestamp = time.time()
+                monotonic = time.monotonic()
+                for name in plan.virtuals:
+                    out.append( ModbusValue(name, self.values[name], None, self.comments.get(name),
+                                            timestamp, monotonic) )
+            outs.append(out)
+        return outs
+
+    # Read a spec or a list of specs (including aliases and virtual registers).
+    def read(self, specs):
+        return self.execute(self.plan(specs))
+
+    #
+    # Generator producing the values of each iteration (see read()).
+    #
+    #  - count    : the number of iterations or 0 for infinite
+    #  - delay    : sleep delay after each iteration when period is None 
+    #  - period   : the fixed cadence of the iterations (see Cadence) 
+    #  - triggers : evaluate the triggers after each iteration (see Trigger)
+    #
+    def monitor(self, specs, count=0, delay=1.0, period=None, overrun='skip', triggers=False):
+        if triggers:
+            plan = self.plan(specs, [ t.value for t in self.triggers.values() ])
+        else:
+            plan = self.plan(specs)
+        self.cadence = Cadence(period, overrun) if period is not None else None
+        self.missed = 0
+        i=0
+        while True:
+            with TRACE.span(f'iteration {i+1}', 'monitor'):
+                if self.pending_writes:
+                    self.flush_writes()
+                values = self.execute(plan, cached=False)
+                if triggers:
+                    self.check_triggers()
+            yield values
+            i=i+1
+            if i==count:
+                break
+            if self.cadence:
+                self.use_idle_time(self.cadence.start + (self.cadence.tick+1)*self.cadence.period)
+                self.missed = self.cadence.wait()
+            else:
+                deadline = time.monotonic() + delay
+                self.use_idle_time(deadline)
+                TRACE.sleep(max(deadline - time.monotonic(), 0))
+
+    #
+    # Return the address and the register values for writing an integer
+    # value into a target of size 1 or 2 (a spec or an alias)
+    #
+    def write_target(self, dest, value):
+
+        # Expand 'dest' and make sure that it describes a single
+        # target of size 1 or 2.  
+        speclist = expand_specifications( [dest] , self.aliases)
+        if len(speclist)==0:
+            raise ValueError(f"Empty assignment target '{dest}'")
+        elif len(speclist)>1:
+            raise ValueError(f"Too many assignment targets in '{dest}'")
+        target = ModbusSpec.parse(speclist[0])
+
+        if target.count not in [1,2]:
+            raise ValueError(f"Illegal assignment target size in '{dest}'. Got {target.count} but need 1 or 2")
+
+        if target.count == 1:
+            # A 16bit value (signed or unsigned)  
+            if not -0x8000 <= value <= 0xFFFF:
+                raise ValueError(f"Value {value} does not fit in 16bit for '{dest}'")
+            return target.start, [value & 0xFFFF]
+        else:
+            # A 32bit value: the high word first (as read by 'U', 'I' and 'X')  
+            if not -0x80000000 <= value <= 0xFFFFFFFF:
+                raise ValueError(f"Value {value} does not fit in 32bit for '{dest}'")
+            hi = (value>>16) & 0xFFFF
+            lo = value & 0xFFFF
+            return target.start, [hi,lo]
+
+    #
+    # Write an integer value into a target of size 1 or 2 (a spec or an alias)
+    # and return the pymodbus response. 
+    #
+    # The write is immediate (see queue_write for a coalescing alternative).
+    #
+    def write(self, dest, value):
+        start, values = self.write_target(dest, value)
+        return self._write(start, values)
+
+    def _write(self, start, values):
+        client = self.connect()
+        ans = write_registers(client, start, values)
+        self.last_writes[start] = time.monotonic()
+        if ans.isError():
+            self.cache.invalidate(start, len(values))
+        else:
+            self.cache.update(start, values)
+        return ans
+
+    # The minimum interval between two writes at address (see 'write_interval')
+    def get_write_interval(self, address):
+        for start, count, interval in self.write_intervals:
+            if start <= address < start+count:
+                return interval
+        return self.write_interval
+
+    #
+    # Queue a write for the next flush_writes(). 
+    #
+    # A queued write replaces the pending write to the same target (last
+    # writer wins).
+    #
+    def queue_write(self, dest, value):
+        start, values = self.write_target(dest, value)
+        self.pending_writes[start] = (dest, values)
+
+    #
+    # Perform the pending writes and return a list of (DEST, VALUES, ANS)
+    # where ANS is the pymodbus response or None if the write was suppressed.
+    #
+    # A write is suppressed when a fresh cached value (see RegisterCache) at
+    # most suppress_ttl seconds old shows that the target already holds the
+    # value, unless force is set.
+    #
+    # A write is deferred when the last write to the same target was less 
+    # than its write interval ago. With wait, this function sleeps until all
+    # the deferred writes are performed. Else they stay pending.
+    #
+    def flush_writes(self, force=False, wait=False):
+        results = []
+        while self.pending_writes:
+            now = time.monotonic()
+            next_time = None
+            for start in list(self.pending_writes.keys()):
+                dest, values = self.pending_writes[start]
+                if not force and self.cache.get(start, len(values), now, self.suppress_ttl) == values:
+                    del self.pending_writes[start]
+                    results.append( (dest, values, None) )
+                    continue
+                allowed = self.last_writes.get(start, -math.inf) + self.get_write_interval(start)
+                if now >= allowed:
+                    del self.pending_writes[start]
+                    results.append( (dest, values, self._write(start, values)) )
+                elif next_time is None or allowed < next_time:
+                    next_time = allowed
+            if not wait or next_time is None:
+                break
+            TRACE.sleep(max(next_time - time.monotonic(), 0))
+        return results
+
+
 ###################################################################
 
-try:
+def main():
 
     parser = argparse.ArgumentParser()
 
@@ -973,6 +3656,12 @@ try:
     parser.add_argument('--host')
     parser.add_argument('--port', type=int)
     parser.add_argument('--marstek-fix', default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument('--stats', action='store_true', help='Report request statistics at the end of read, scan, monitor and batch')
+    parser.add_argument('--trace', metavar='FILE', help='Save a timeline of the requests in Chrome trace-event JSON format')
+    parser.add_argument('--image', metavar='FILE', help='Update (or read with peek) a shared memory-mapped image of the registers')
+    parser.add_argument('--prefetch', action='store_true', help='Widen the reads to the known blocks of registers and reuse the cached values')
+    parser.add_argument('--scan-map', metavar='FILE', help='Also use the blocks found by a scan (its output) for --prefetch')
+    parser.add_argument('--background-scan', metavar='FILE', help='Scan for registers in the idle time of monitor, serve-metrics and publish (state in FILE)')
     
     subparsers = parser.add_subparsers(dest='command',help='subcommand help')
     add_command_scan(subparsers)
@@ -981,56 +3670,83 @@ try:
     add_command_test(subparsers)
     add_command_monitor(subparsers)
     add_command_write(subparsers)
+    add_command_batch(subparsers)
+    add_command_peek(subparsers)
+    add_command_probe_rate(subparsers)
+    add_command_serve_metrics(subparsers)
+    add_command_publish(subparsers)
     args = parser.parse_args()
 
     if args.command == None :
         parser.print_help()        
         sys.exit(1)
 
-    if args.config:
-        what   = args.config
-        config_data = yamale.make_data(args.config)
-    else:
-        what   = 'YAMALE_DEFAULT_CONFIG'
-        config_data = YAMALE_DEFAULT_CONFIG
-
     logging.basicConfig()
-    log = logging.getLogger('pymodbus')
     log.setLevel(logging.INFO)
     
-    config = validate_config( what, config_data ) 
-    
-    populate_comments( COMMENTS, config.get('info',{}) )
+    try:
+        session = VenusSession(args.config, args.host, args.port, args.marstek_fix, args.prefetch)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if args.scan_map:
+        try:
+            session.add_blocks(load_scan_map(args.scan_map))
+        except OSError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+    if args.background_scan:
+        try:
+            session.background = BackgroundScan(args.background_scan)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: Cannot load the scan state {args.background_scan}: {e}")
+            sys.exit(1)
 
-    ALIASES = get_all_aliases(config)
-    
-    log.setLevel(logging.INFO)
-    
-    config['global'] = config.get('global', {} )
-    config_global = config['global']
-    config_global['host'] = args.host or config_global.get('host', DEFAULT_HOSTNAME)
-    config_global['port'] = args.port or config_global.get('port', DEFAULT_PORT)
-    
-    if args.command == 'read' :
-        action_read(args,config)
-    elif args.command == 'read2' :
-        action_read2(args,config)
-    elif args.command == 'scan' :
-        action_scan(args,config)
-    elif args.command == 'test' :
-        action_test(args,config)
-    elif args.command == 'monitor' :
-        action_monitor(args,config)
-    elif args.command == 'aliases' :
-        action_aliases(args,config)
-    elif args.command == 'write' :
-        action_write(args,config)
-    else:
-        print("Unsupported command")
+    TRACE.enabled = bool(args.trace)
+
+    if args.image and args.command != 'peek':
+        IMAGE.open(args.image, writable=True)
+
+    try:
+        if args.command == 'read' :
+            action_read(args,session)
+        elif args.command == 'scan' :
+            action_scan(args,session)
+        elif args.command == 'test' :
+            action_test(args,session)
+        elif args.command == 'monitor' :
+            action_monitor(args,session)
+        elif args.command == 'aliases' :
+            action_aliases(args,session)
+        elif args.command == 'write' :
+            action_write(args,session)
+        elif args.command == 'batch' :
+            action_batch(args,session)
+        elif args.command == 'peek' :
+            action_peek(args,session)
+        elif args.command == 'probe-rate' :
+            action_probe_rate(args,session)
+        elif args.command == 'serve-metrics' :
+            action_serve_metrics(args,session)
+        elif args.command == 'publish' :
+            action_publish(args,session)
+        else:
+            print("Unsupported command")
+            sys.exit(1)
+    except ValueError as e:
+        # e.g. an unknown alias or a malformed specification
+        print(f"Error: {e}")
         sys.exit(1)
+    finally:
+        # Also save the trace after CTRL-C 
+        if args.trace:
+            TRACE.save(args.trace)
 
     sys.exit(0)
 
-except KeyboardInterrupt:    
-    pass
 
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:    
+        pass